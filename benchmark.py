@@ -0,0 +1,529 @@
+import io
+import os
+import sys
+import json
+import time
+import random
+import itertools
+import shutil
+import logging
+import argparse
+import platform
+import tempfile
+import threading
+import subprocess
+from contextlib import redirect_stdout
+from datetime import datetime, timezone
+from types import SimpleNamespace
+from metrics import metrics
+
+# Stages in the order they run, and the metrics stage whose samples give each one's tail latency
+stage_names = ["rasterize", "ocr", "correct", "spacy", "hf", "cleanup"]
+latency_stages = {"rasterize": "render", "ocr": "generate", "correct": "correct", "spacy": "ner", "hf": "ner",
+                  "cleanup": "cleanup_delete"}
+
+results_file = "./benchmarks/results.jsonl"
+
+# Words the synthetic pages and the fake OCR output are made of. The names include the variants typo_rules.tsv
+# corrects, so the correction and NER stages have real work to do.
+sample_names = [
+    "CARL N. FREEMAN", "CARL H. FREEMAN", "CARL M. FREEMAN", "Carl Freeman", "Ruey", "RUEY", "Margaret Holloway",
+    "Walter Brandt", "Eleanor Price", "Washington", "Chicago", "Baltimore", "Department of State",
+    "General Electric", "First National Bank",
+]
+filler_words = (
+    "the of and to in a for on with by was report meeting letter committee office department memorandum "
+    "request account statement March April June October records received forwarded attached reference "
+    "subject copy file regarding payment approved director board annual review"
+).split()
+
+def make_line(rng, words_per_line=12):
+    """Return one line of synthetic document text."""
+    words = []
+    for _ in range(words_per_line):
+        words.append(rng.choice(sample_names) if rng.random() < 0.08 else rng.choice(filler_words))
+    return " ".join(words)
+
+def make_page_text(rng, lines_per_page):
+    return "\n".join(make_line(rng) for _ in range(lines_per_page))
+
+def make_synthetic_pdfs(pdf_directory, pdf_count, pages_per_pdf, lines_per_page, seed=0, image_directory=None):
+    """Write pdf_count PDFs of pages_per_pdf letter-size pages holding lines_per_page lines of text each.
+
+    With an image_directory the pages are also saved as PNGs where pdftopng.py would put them, so the OCR
+    stage can run without the rasterize stage. Returns the total number of pages.
+    """
+    from PIL import Image, ImageDraw
+
+    rng = random.Random(seed)
+    subfolder = os.path.join(pdf_directory, "synthetic")
+    os.makedirs(subfolder, exist_ok=True)
+    if image_directory is not None:
+        os.makedirs(os.path.join(image_directory, "synthetic"), exist_ok=True)
+
+    # Letter size at 150 DPI with a one inch margin
+    width, height, margin = 1275, 1650, 150
+    line_height = max(10, (height - 2 * margin) // max(1, lines_per_page))
+
+    for index in range(pdf_count):
+        name = f"document_{index + 1:03d}"
+        pages = []
+        for page_number in range(1, pages_per_pdf + 1):
+            page = Image.new("L", (width, height), 255)
+            draw = ImageDraw.Draw(page)
+            for line in range(lines_per_page):
+                draw.text((margin, margin + line * line_height), make_line(rng), fill=0)
+            if image_directory is not None:
+                page.save(os.path.join(image_directory, "synthetic", f"{name}_page_{page_number}.png"), "PNG")
+            pages.append(page)
+        pages[0].save(os.path.join(subfolder, f"{name}.pdf"), "PDF", resolution=150, save_all=True,
+                      append_images=pages[1:])
+        for page in pages:
+            page.close()
+
+    return pdf_count * pages_per_pdf
+
+def make_fake_gemini(settings):
+    return FakeGemini(settings["latency"], settings["jitter"], settings["throttle_rate"], settings["max_tokens_rate"],
+                      settings["lines_per_page"], settings["seed"])
+
+class FakeThrottleError(Exception):
+    """Stands in for the API's 429 ResourceExhausted error, which call_with_retry backs off on."""
+    code = 429
+
+class FakeGemini:
+    """Local stand-in for the parts of google.generativeai the OCR stage uses.
+
+    It replaces both geminiocr.model (generate_content) and the genai module (upload_file, delete_file, list_files).
+    Each request takes latency seconds times a log-normal factor, fails with a 429 at throttle_rate and
+    stops with MAX_TOKENS at max_tokens_rate. Responses are synthetic text of lines_per_page lines per image.
+    """
+
+    def __init__(self, latency=0.5, jitter=0.5, throttle_rate=0.0, max_tokens_rate=0.0, lines_per_page=40, seed=0):
+        self.latency = latency
+        self.jitter = jitter
+        self.throttle_rate = throttle_rate
+        self.max_tokens_rate = max_tokens_rate
+        self.lines_per_page = lines_per_page
+        self.seed = seed
+        self.lock = threading.Lock()
+        self.calls = 0
+        self.file_ids = itertools.count(1)
+        self.files = {}
+
+    def _rng(self):
+        # One generator per call keeps the responses reproducible without sharing state between threads
+        with self.lock:
+            self.calls += 1
+            return random.Random(self.seed * 1000003 + self.calls)
+
+    def _request(self, rng, scale=1.0):
+        time.sleep(self.latency * scale * rng.lognormvariate(0, self.jitter))
+        if rng.random() < self.throttle_rate:
+            raise FakeThrottleError("429 Resource has been exhausted (fake Gemini)")
+
+    def upload_file(self, path, mime_type=None, display_name=None):
+        rng = self._rng()
+        self._request(rng, scale=0.2)
+        with self.lock:
+            file_id = f"fake{next(self.file_ids)}"
+            file = SimpleNamespace(
+                name=f"files/{file_id}",
+                uri=f"https://fake-gemini.local/v1beta/files/{file_id}",
+                display_name=display_name or (os.path.basename(path) if isinstance(path, str) else "upload"),
+                mime_type=mime_type,
+                size_bytes=os.path.getsize(path) if isinstance(path, str) else len(path.getvalue()),
+                create_time=datetime.now(timezone.utc),
+            )
+            self.files[file_id] = file
+        return file
+
+    def delete_file(self, name):
+        rng = self._rng()
+        self._request(rng, scale=0.1)
+        with self.lock:
+            self.files.pop(name.split('/')[-1], None)
+
+    def list_files(self, page_size=None):
+        with self.lock:
+            files = list(self.files.values())
+        yield from files
+
+    def generate_content(self, contents):
+        rng = self._rng()
+        self._request(rng)
+
+        image_count = sum(1 for part in contents if not isinstance(part, str))
+        if rng.random() < self.max_tokens_rate:
+            # Text cut off where the output limit was reached
+            finish_reason, text = 2, make_page_text(rng, self.lines_per_page // 2)
+        elif image_count > 1:
+            finish_reason = 1
+            text = "\n".join(f"=== PAGE {number} ===\n{make_page_text(rng, self.lines_per_page)}"
+                             for number in range(1, image_count + 1))
+        else:
+            finish_reason, text = 1, make_page_text(rng, self.lines_per_page)
+
+        prompt_tokens = 258 * image_count + 40
+        output_tokens = len(text) // 4
+        return SimpleNamespace(
+            candidates=[SimpleNamespace(finish_reason=finish_reason, content=SimpleNamespace(parts=[SimpleNamespace(text=text)]))],
+            usage_metadata=SimpleNamespace(prompt_token_count=prompt_tokens, candidates_token_count=output_tokens,
+                                           total_token_count=prompt_tokens + output_tokens),
+        )
+
+def child_pids(pid):
+    """Return the descendants of a process, read from /proc (Linux only)."""
+    children = []
+    try:
+        for task in os.listdir(f"/proc/{pid}/task"):
+            with open(f"/proc/{pid}/task/{task}/children") as f:
+                children.extend(int(child) for child in f.read().split())
+    except OSError:
+        return []
+    for child in list(children):
+        children.extend(child_pids(child))
+    return children
+
+def current_rss():
+    """Resident memory in bytes of this process and its children, or None where /proc is not available."""
+    page_size = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+    total = 0
+    for pid in [os.getpid()] + child_pids(os.getpid()):
+        try:
+            with open(f"/proc/{pid}/statm") as f:
+                total += int(f.read().split()[1]) * page_size
+        except OSError:
+            if pid == os.getpid():
+                return None
+    return total
+
+class PeakMemory:
+    """Samples the resident memory of the process tree in a background thread while the with block runs."""
+
+    def __init__(self, interval=0.05):
+        self.interval = interval
+        self.peak = None
+        self.stopped = threading.Event()
+
+    def sample(self):
+        rss = current_rss()
+        if rss is not None:
+            self.peak = max(self.peak or 0, rss)
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.sample()
+
+    def __enter__(self):
+        self.sample()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stopped.set()
+        self.thread.join()
+        self.sample()
+        if self.peak is None:
+            # Without /proc, fall back to the lifetime maximum the OS reports (kilobytes on Linux, bytes on macOS)
+            try:
+                import resource
+                scale = 1 if sys.platform == "darwin" else 1024
+                self.peak = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                                resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss) * scale
+            except ImportError:
+                pass
+
+def count_files(directory, extension):
+    return sum(1 for _, _, files in os.walk(directory) for file in files if file.endswith(extension))
+
+def bench_rasterize(context):
+    import pdftopng
+
+    # Keep the manifest inside the scratch directory so every run renders every page
+    pdftopng.manifest_file = os.path.join(context["workdir"], "manifest_pdftopng.sqlite")
+    pdftopng.checkpoint_file = os.path.join(context["workdir"], "checkpoint_pdftopng.json")
+    start = time.perf_counter()
+    pdftopng.process_pdfs_parallel(context["pdf_directory"], context["image_directory"],
+                                   workers=context["settings"]["render_workers"], chunk_size=10)
+    return count_files(context["image_directory"], ".png"), time.perf_counter() - start
+
+def bench_ocr(context):
+    import geminiocr
+    from ratelimit import RateLimiter
+
+    settings = context["settings"]
+    fake = make_fake_gemini(settings)
+    real_model, real_genai = geminiocr.model, geminiocr.genai
+    geminiocr.model, geminiocr.genai = fake, fake
+    try:
+        limiter = RateLimiter(settings["requests_per_minute"], settings["tokens_per_minute"])
+        start = time.perf_counter()
+        geminiocr.process_images(context["image_directory"], context["text_directory"], set(),
+                                 os.path.join(context["workdir"], "unfinished_files.csv"),
+                                 max_in_flight=settings["ocr_workers"], limiter=limiter, estimated_tokens=1500,
+                                 transfer_mode=settings["transfer_mode"], batch_size=settings["batch_size"])
+        elapsed = time.perf_counter() - start
+    finally:
+        geminiocr.model, geminiocr.genai = real_model, real_genai
+    return count_files(context["text_directory"], ".txt"), elapsed
+
+def bench_cleanup(context):
+    import cleanupgeminifiles
+
+    # Leftover uploads, one per page of the corpus, as crashed OCR runs would leave them
+    settings = context["settings"]
+    fake = make_fake_gemini(settings)
+    page_count = settings["pdfs"] * settings["pages_per_pdf"]
+    for page in range(page_count):
+        fake.files[f"leftover{page}"] = SimpleNamespace(
+            name=f"files/leftover{page}", uri=f"https://fake-gemini.local/v1beta/files/leftover{page}",
+            display_name=f"carl-ocr-page_{page}.png", size_bytes=0, create_time=datetime.now(timezone.utc))
+
+    real_genai = cleanupgeminifiles.genai
+    cleanupgeminifiles.genai = fake
+    try:
+        start = time.perf_counter()
+        deleted, _ = cleanupgeminifiles.cleanup_gemini_files(workers=settings["ocr_workers"], assume_yes=True)
+        elapsed = time.perf_counter() - start
+    finally:
+        cleanupgeminifiles.genai = real_genai
+    return deleted, elapsed
+
+def bench_correct(context):
+    import typos
+
+    rules = typos.load_rules(os.path.join(os.path.dirname(os.path.abspath(__file__)), "typo_rules.tsv"))
+    start = time.perf_counter()
+    typos.process_directory(context["text_directory"], rules)
+    return count_files(context["text_directory"], ".txt"), time.perf_counter() - start
+
+def bench_spacy(context):
+    import spacy_entityextraction
+    from entity_sink import open_sink
+
+    nlp = spacy_entityextraction.load_model()
+    sink = open_sink(os.path.join(context["workdir"], "entities_spacy.jsonl"))
+    try:
+        start = time.perf_counter()
+        spacy_entityextraction.process_directory(nlp, context["text_directory"], sink)
+        elapsed = time.perf_counter() - start
+    finally:
+        sink.close()
+    return count_files(context["text_directory"], ".txt"), elapsed
+
+def bench_hf(context):
+    import huggingface_entityextraction as hf
+    from entity_sink import open_sink
+
+    ner_pipeline = hf.load_pipeline(hf.model_name, hf.backend)
+    sink = open_sink(os.path.join(context["workdir"], "entities_hf.jsonl"))
+    try:
+        start = time.perf_counter()
+        hf.process_directory(ner_pipeline, context["text_directory"], sink, batch_size=hf.batch_size,
+                             max_tokens=hf.max_window_tokens, stride=hf.window_stride)
+        elapsed = time.perf_counter() - start
+    finally:
+        sink.close()
+    return count_files(context["text_directory"], ".txt"), elapsed
+
+stage_functions = {
+    "rasterize": bench_rasterize,
+    "ocr": bench_ocr,
+    "correct": bench_correct,
+    "spacy": bench_spacy,
+    "hf": bench_hf,
+    "cleanup": bench_cleanup,
+}
+
+def run_stage(name, context, verbose=False):
+    """Run one stage and return its throughput, peak memory, tail latency and counters.
+
+    Model loading counts towards peak memory but not towards the timed part.
+    """
+    metrics.reset()
+    output = sys.stdout if verbose else io.StringIO()
+    try:
+        with PeakMemory() as memory, redirect_stdout(output):
+            pages, elapsed = stage_functions[name](context)
+    except Exception as e:
+        logging.error(f"Stage {name} failed: {e}")
+        return {"skipped": f"{type(e).__name__}: {e}"}
+
+    summary = metrics.summary()
+    latency = summary["stages"].get(latency_stages[name], {})
+    return {
+        "pages": pages,
+        "seconds": round(elapsed, 3),
+        "pages_per_second": round(pages / elapsed, 3) if elapsed > 0 else 0.0,
+        "peak_rss_mb": round(memory.peak / 2 ** 20, 1) if memory.peak is not None else None,
+        "p50_ms": round(latency.get("p50", 0.0) * 1000, 1),
+        "p95_ms": round(latency.get("p95", 0.0) * 1000, 1),
+        "p99_ms": round(latency.get("p99", 0.0) * 1000, 1),
+        "counters": {counter: round(value, 3) for counter, value in summary["counters"].items()},
+    }
+
+def git_revision():
+    try:
+        result = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__)))
+        return result.stdout.strip() or None
+    except OSError:
+        return None
+
+def load_previous_run(path, settings):
+    """Return the most recent stored run made with the same settings, or None."""
+    previous = None
+    if os.path.exists(path):
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                if line.strip():
+                    run = json.loads(line)
+                    if run.get("settings") == settings:
+                        previous = run
+    return previous
+
+def compare_runs(current, previous, tolerance):
+    """Print the change of every stage against the previous run. Returns the stages that regressed.
+
+    A stage regresses when its pages/sec drops, or its p95 latency grows, by more than tolerance (a fraction).
+    """
+    regressions = []
+    print(f"Compared with the run of {previous['run_at']} ({previous.get('revision') or 'unknown revision'}):")
+    for stage, stats in current["stages"].items():
+        before = previous["stages"].get(stage, {})
+        if "pages_per_second" not in stats or "pages_per_second" not in before:
+            continue
+        rate_change = (stats["pages_per_second"] - before["pages_per_second"]) / before["pages_per_second"] if before["pages_per_second"] else 0.0
+        p95_change = (stats["p95_ms"] - before["p95_ms"]) / before["p95_ms"] if before["p95_ms"] else 0.0
+        regressed = rate_change < -tolerance or p95_change > tolerance
+        if regressed:
+            regressions.append(stage)
+        print(f"  {stage}: pages/sec {rate_change:+.1%}, p95 {p95_change:+.1%}{'  REGRESSION' if regressed else ''}")
+    return regressions
+
+def print_run(run):
+    for stage, stats in run["stages"].items():
+        if "skipped" in stats:
+            print(f"{stage}: skipped ({stats['skipped']})")
+            continue
+        print(f"{stage}: {stats['pages']} pages in {stats['seconds']:.1f}s ({stats['pages_per_second']:.2f} pages/sec), "
+              f"peak memory {stats['peak_rss_mb']} MB, p50 {stats['p50_ms']} ms, p95 {stats['p95_ms']} ms, p99 {stats['p99_ms']} ms")
+        if stats["counters"]:
+            print(f"  {', '.join(f'{name} {value}' for name, value in sorted(stats['counters'].items()))}")
+
+def run_benchmark(settings, workdir, results_path, tolerance=0.1, verbose=False):
+    """Generate the synthetic corpus, run the selected stages on it, store the results and compare with the last run.
+
+    Returns the list of stages that regressed against the previous run with the same settings.
+    """
+    context = {
+        "settings": settings,
+        "workdir": workdir,
+        "pdf_directory": os.path.join(workdir, "pdfs"),
+        "image_directory": os.path.join(workdir, "images"),
+        "text_directory": os.path.join(workdir, "text"),
+    }
+    os.makedirs(context["text_directory"], exist_ok=True)
+
+    # Without the rasterize stage the OCR stage works from the generated page images
+    png_directory = None if "rasterize" in settings["stages"] else context["image_directory"]
+    pages = make_synthetic_pdfs(context["pdf_directory"], settings["pdfs"], settings["pages_per_pdf"],
+                                settings["lines_per_page"], settings["seed"], png_directory)
+    print(f"Generated {pages} synthetic pages in {settings['pdfs']} PDF(s) under {workdir}")
+
+    run = {
+        "run_at": datetime.now().isoformat(timespec="seconds"),
+        "revision": git_revision(),
+        "python": platform.python_version(),
+        "cpu_count": os.cpu_count(),
+        "settings": settings,
+        "stages": {},
+    }
+    for stage in stage_names:
+        if stage in settings["stages"]:
+            print(f"Running {stage}...")
+            run["stages"][stage] = run_stage(stage, context, verbose)
+
+    print_run(run)
+
+    regressions = []
+    previous = load_previous_run(results_path, settings)
+    if previous is not None:
+        regressions = compare_runs(run, previous, tolerance)
+
+    directory = os.path.dirname(results_path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    with open(results_path, "a", encoding="utf-8") as f:
+        f.write(json.dumps(run) + "\n")
+    print(f"Results appended to {results_path}")
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the pipeline stages offline on synthetic PDFs and a fake Gemini service.")
+    parser.add_argument("--stages", default="rasterize,ocr,correct,spacy,cleanup",
+                        help=f"Comma-separated stages to run, from {', '.join(stage_names)}")
+    parser.add_argument("--pdfs", type=int, default=4, help="Number of synthetic PDFs")
+    parser.add_argument("--pages-per-pdf", type=int, default=25, help="Pages in each synthetic PDF")
+    parser.add_argument("--lines-per-page", type=int, default=40, help="Text density of the synthetic pages")
+    parser.add_argument("--latency", type=float, default=0.5, help="Median latency of a fake Gemini request in seconds")
+    parser.add_argument("--jitter", type=float, default=0.5, help="Spread of the log-normal latency (0 for constant latency)")
+    parser.add_argument("--throttle-rate", type=float, default=0.02, help="Fraction of fake requests failing with 429")
+    parser.add_argument("--max-tokens-rate", type=float, default=0.02, help="Fraction of fake requests stopping with MAX_TOKENS")
+    parser.add_argument("--ocr-workers", type=int, default=8, help="Concurrent OCR requests")
+    parser.add_argument("--transfer-mode", choices=["inline", "upload"], default="inline")
+    parser.add_argument("--batch-size", type=int, default=1, help="Pages per OCR request")
+    parser.add_argument("--requests-per-minute", type=int, default=1000)
+    parser.add_argument("--tokens-per-minute", type=int, default=4000000)
+    parser.add_argument("--render-workers", type=int, default=None, help="Rasterize worker processes (default: every core)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--results", default=results_file, help="JSONL file the runs are appended to")
+    parser.add_argument("--tolerance", type=float, default=0.1, help="Relative slowdown reported as a regression")
+    parser.add_argument("--workdir", help="Directory for the synthetic corpus and outputs (default: a temporary directory)")
+    parser.add_argument("--keep", action="store_true", help="Keep the temporary directory")
+    parser.add_argument("--verbose", action="store_true", help="Show the output of the stages")
+    args = parser.parse_args()
+
+    stages = [stage.strip() for stage in args.stages.split(",") if stage.strip()]
+    unknown = [stage for stage in stages if stage not in stage_names]
+    if unknown:
+        parser.error(f"Unknown stage(s): {', '.join(unknown)}")
+
+    # Runs are only compared with earlier runs of the same settings
+    settings = {
+        "stages": stages,
+        "pdfs": args.pdfs,
+        "pages_per_pdf": args.pages_per_pdf,
+        "lines_per_page": args.lines_per_page,
+        "latency": args.latency,
+        "jitter": args.jitter,
+        "throttle_rate": args.throttle_rate,
+        "max_tokens_rate": args.max_tokens_rate,
+        "ocr_workers": args.ocr_workers,
+        "transfer_mode": args.transfer_mode,
+        "batch_size": args.batch_size,
+        "requests_per_minute": args.requests_per_minute,
+        "tokens_per_minute": args.tokens_per_minute,
+        "render_workers": args.render_workers,
+        "seed": args.seed,
+    }
+
+    # geminiocr.py logs every page and its text at INFO level
+    if not args.verbose:
+        logging.disable(logging.INFO)
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix="carl_benchmark_")
+    try:
+        regressions = run_benchmark(settings, workdir, args.results, args.tolerance, args.verbose)
+    finally:
+        if args.workdir is None and not args.keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    if regressions:
+        print(f"Regressed stages: {', '.join(regressions)}")
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
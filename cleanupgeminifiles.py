@@ -1,58 +1,152 @@
 import os
+import argparse
+import threading
+from datetime import datetime, timedelta, timezone
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
 import google.generativeai as genai
+from metrics import metrics
+from ratelimit import call_with_retry
 
 # Configure the Gemini API key
 genai.configure(api_key=os.environ.get("GEMINI_API_KEY"))
 
-def list_gemini_files():
-    """Lists the files uploaded to your Gemini AI account."""
+# Files are listed a page at a time, so the listing is never held in memory as a whole
+list_page_size = 100
+
+def file_matches(file, min_age=None, prefix=None, now=None):
+    """Return True if the file is at least min_age old (a timedelta) and its display name starts with prefix."""
+    if prefix and not (file.display_name or "").startswith(prefix):
+        return False
+    if min_age is not None:
+        created = file.create_time
+        if created.tzinfo is None:
+            created = created.replace(tzinfo=timezone.utc)
+        if (now or datetime.now(timezone.utc)) - created < min_age:
+            return False
+    return True
+
+def iter_gemini_files(min_age=None, prefix=None):
+    """Yields the files uploaded to your Gemini AI account that match the filters, streaming the listing."""
+    now = datetime.now(timezone.utc)
+    for file in genai.list_files(page_size=list_page_size):
+        if file_matches(file, min_age, prefix, now):
+            yield file
+
+def list_gemini_files(min_age=None, prefix=None):
+    """Prints the files uploaded to your Gemini AI account that match the filters. Returns how many there are."""
+    count = 0
     try:
-        # Call the API to list files
-        files = list(genai.list_files())  # Converting the generator to a list
-        
-        if files:
-            print(f"Total files found: {len(files)}")
-            for idx, file in enumerate(files):
-                print(f"{idx + 1}. File URI: {file.uri}, Display Name: {file.display_name}, Size: {file.size_bytes} bytes, Created: {file.create_time}")
-            return files
-        else:
-            print("No files found.")
-            return []
+        for file in iter_gemini_files(min_age, prefix):
+            count += 1
+            print(f"{count}. File URI: {file.uri}, Display Name: {file.display_name}, Size: {file.size_bytes} bytes, Created: {file.create_time}")
     except Exception as e:
         print(f"Failed to list files: {e}")
-        return []
+    print(f"Total files found: {count}" if count else "No files found.")
+    return count
 
-def delete_gemini_file(file_uri):
-    """Deletes a file from Gemini AI using its URI."""
+def delete_gemini_file(file_uri, output=print):
+    """Deletes a file from Gemini AI using its URI, retrying throttling and server errors. Returns True on success."""
     try:
         # Extract the file ID from the URI
         file_id = file_uri.split('/')[-1]
 
         # Call the delete_file method with only the file ID
-        genai.delete_file(file_id)
-        print(f"Deleted file with URI: {file_uri}")
+        with metrics.timer("cleanup_delete", file_uri):
+            call_with_retry(genai.delete_file, file_id, description=f"delete of {file_uri}")
+        output(f"Deleted file with URI: {file_uri}")
+        return True
     except Exception as e:
-        print(f"Failed to delete file with URI {file_uri}: {e}")
+        output(f"Failed to delete file with URI {file_uri}: {e}")
+        return False
 
-def cleanup_gemini_files():
-    """Lists and deletes all files from Gemini AI after user confirmation."""
-    # List all files
-    files = list_gemini_files()
+def delete_files(files, workers=16, dry_run=False, output=print):
+    """Delete files from an iterable with a pool of worker threads. Returns the number deleted and failed.
 
-    if not files:
-        print("No files to delete.")
-        return
+    At most twice as many deletions as there are workers are queued, so the listing is consumed only as fast
+    as files are deleted. With dry_run the files are only printed.
+    """
+    counts = {"deleted": 0, "failed": 0}
 
-    # Ask for user confirmation
-    confirm = input("Do you want to delete all these files? (yes/no): ").strip().lower()
-    
-    if confirm == 'yes':
-        print("Deleting files...")
+    def collect(futures):
+        for future in futures:
+            counts["deleted" if future.result() else "failed"] += 1
+
+    if dry_run:
         for file in files:
-            delete_gemini_file(file.uri)
-        print("All files deleted.")
+            output(f"Would delete {file.uri} ({file.display_name}, created {file.create_time})")
+            counts["deleted"] += 1
+        return counts["deleted"], counts["failed"]
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = set()
+        for file in files:
+            if len(pending) >= workers * 2:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                collect(done)
+            pending.add(executor.submit(delete_gemini_file, file.uri, output))
+        collect(pending)
+
+    return counts["deleted"], counts["failed"]
+
+def describe_filters(min_age=None, prefix=None):
+    description = "all files"
+    if prefix:
+        description += f" whose display name starts with '{prefix}'"
+    if min_age is not None:
+        description += f" older than {min_age}"
+    return description
+
+def cleanup_gemini_files(min_age=None, prefix=None, workers=16, dry_run=False, assume_yes=False, output=print):
+    """Deletes the files matching the filters from Gemini AI, after user confirmation unless assume_yes is set."""
+    description = describe_filters(min_age, prefix)
+
+    # Ask for user confirmation
+    if not dry_run and not assume_yes:
+        confirm = input(f"Do you want to delete {description}? (yes/no): ").strip().lower()
+        if confirm != 'yes':
+            output("Operation canceled. No files were deleted.")
+            return 0, 0
+
+    output(f"{'Listing' if dry_run else 'Deleting'} {description}...")
+    try:
+        deleted, failed = delete_files(iter_gemini_files(min_age, prefix), workers, dry_run, output)
+    except Exception as e:
+        output(f"Failed to list files: {e}")
+        return 0, 0
+
+    if dry_run:
+        output(f"{deleted} file(s) would be deleted.")
     else:
-        print("Operation canceled. No files were deleted.")
+        output(f"Deleted {deleted} file(s), {failed} failed.")
+    return deleted, failed
+
+def start_background_cleanup(min_age, prefix=None, interval=timedelta(minutes=30), workers=4, output=print):
+    """Periodically delete matching files from a daemon thread, e.g. uploads orphaned by crashed runs.
+
+    Returns an event; set it to stop the thread after the current pass.
+    """
+    stop = threading.Event()
+
+    def run():
+        while not stop.is_set():
+            cleanup_gemini_files(min_age, prefix, workers, assume_yes=True, output=output)
+            stop.wait(interval.total_seconds())
+
+    threading.Thread(target=run, daemon=True, name="gemini-cleanup").start()
+    return stop
 
 if __name__ == "__main__":
-    cleanup_gemini_files()
+    parser = argparse.ArgumentParser(description="Delete files uploaded to Gemini AI.")
+    parser.add_argument("--list", action="store_true", help="Only list the matching files")
+    parser.add_argument("--older-than-hours", type=float, help="Only files created at least this many hours ago")
+    parser.add_argument("--prefix", help="Only files whose display name starts with this prefix")
+    parser.add_argument("--workers", type=int, default=16, help="Concurrent delete requests")
+    parser.add_argument("--dry-run", action="store_true", help="Show what would be deleted without deleting anything")
+    parser.add_argument("--yes", action="store_true", help="Delete without asking for confirmation")
+    args = parser.parse_args()
+
+    min_age = timedelta(hours=args.older_than_hours) if args.older_than_hours is not None else None
+    if args.list:
+        list_gemini_files(min_age, args.prefix)
+    else:
+        cleanup_gemini_files(min_age, args.prefix, args.workers, args.dry_run, args.yes)
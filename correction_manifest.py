@@ -0,0 +1,72 @@
+import os
+import json
+import sqlite3
+import hashlib
+from datetime import datetime
+
+def hash_content(content):
+    """Return the SHA-256 of the text content."""
+    return hashlib.sha256(content.encode('utf-8')).hexdigest()
+
+def rules_version(rules):
+    """Return a hash identifying the rule set, so any change to the rules changes the version."""
+    digest = hashlib.sha256()
+    for rule in rules:
+        digest.update(f"{rule.kind}\t{rule.pattern}\t{rule.replacement}\n".encode('utf-8'))
+    return digest.hexdigest()
+
+class CorrectionManifest:
+    """Records, per text file, the hash of its corrected content, the rule set applied and the replacement counts.
+
+    Files are keyed by absolute path, so tools that reach the same file through different relative paths
+    share its record.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.conn = sqlite3.connect(path, timeout=30)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            """CREATE TABLE IF NOT EXISTS files (
+                path TEXT PRIMARY KEY,
+                size INTEGER NOT NULL,
+                mtime_ns INTEGER NOT NULL,
+                content_hash TEXT NOT NULL,
+                rules_version TEXT NOT NULL,
+                counts TEXT NOT NULL,
+                updated_at TEXT NOT NULL
+            )"""
+        )
+        self.conn.commit()
+
+    def lookup(self, path):
+        """Return (size, mtime_ns, content_hash, rules_version, counts) for the file, or None."""
+        row = self.conn.execute(
+            "SELECT size, mtime_ns, content_hash, rules_version, counts FROM files WHERE path = ?", (os.path.abspath(path),)
+        ).fetchone()
+        if row is None:
+            return None
+        return row[0], row[1], row[2], row[3], json.loads(row[4])
+
+    def record(self, results):
+        """Store a batch of (path, size, mtime_ns, content_hash, rules_version, counts) in one transaction."""
+        now = datetime.now().isoformat()
+        with self.conn:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO files (path, size, mtime_ns, content_hash, rules_version, counts, updated_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                [(os.path.abspath(path), size, mtime_ns, content_hash, version, json.dumps(counts), now)
+                 for path, size, mtime_ns, content_hash, version, counts in results],
+            )
+
+    def total_counts(self):
+        """Sum the stored replacement counts over every file in the manifest."""
+        totals = {}
+        for (counts,) in self.conn.execute("SELECT counts FROM files"):
+            for pattern, count in json.loads(counts).items():
+                totals[pattern] = totals.get(pattern, 0) + count
+        return totals
+
+    def close(self):
+        self.conn.close()
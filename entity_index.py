@@ -0,0 +1,263 @@
+import os
+import glob
+import time
+import sqlite3
+import argparse
+from entity_sink import read_entities
+
+def normalize_entity(text):
+    """Normalize an entity name for lookups: case-insensitive and with whitespace collapsed."""
+    return " ".join(text.split()).casefold()
+
+class EntityIndex:
+    """SQLite index of the OCR text (full-text search with FTS5) and of the entity mentions found in it.
+
+    Both parts update incrementally: text files and entity output files are only reloaded when their
+    size or modification time changed since the last build, and what was loaded from files that are gone
+    or no longer part of the build is dropped.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.conn = sqlite3.connect(path, timeout=30)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS files (
+                id INTEGER PRIMARY KEY,
+                path TEXT UNIQUE NOT NULL,
+                size INTEGER NOT NULL,
+                mtime_ns INTEGER NOT NULL,
+                generation INTEGER NOT NULL
+            );
+            CREATE VIRTUAL TABLE IF NOT EXISTS page_text USING fts5(text);
+            CREATE TABLE IF NOT EXISTS entity_sources (
+                path TEXT PRIMARY KEY,
+                size INTEGER NOT NULL,
+                mtime_ns INTEGER NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS entities (
+                id INTEGER PRIMARY KEY,
+                entity TEXT NOT NULL,
+                entity_norm TEXT NOT NULL,
+                label TEXT NOT NULL,
+                file_path TEXT NOT NULL,
+                start_char INTEGER NOT NULL,
+                end_char INTEGER NOT NULL,
+                source TEXT NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS entities_norm ON entities (entity_norm);
+            CREATE INDEX IF NOT EXISTS entities_label ON entities (label, entity_norm);
+            CREATE INDEX IF NOT EXISTS entities_source ON entities (source);
+            """
+        )
+        self.conn.commit()
+
+    def update_text(self, text_directory):
+        """Index new and changed text files under the directory and drop the ones that disappeared."""
+        generation = self.conn.execute("SELECT COALESCE(MAX(generation), 0) + 1 FROM files").fetchone()[0]
+        indexed = 0
+        unchanged = 0
+
+        with self.conn:
+            for root, _, files in os.walk(text_directory):
+                for file in files:
+                    if not file.endswith('.txt'):
+                        continue
+                    path = os.path.normpath(os.path.join(root, file))
+                    stat = os.stat(path)
+                    row = self.conn.execute("SELECT id, size, mtime_ns FROM files WHERE path = ?", (path,)).fetchone()
+
+                    if row is not None and (row[1], row[2]) == (stat.st_size, stat.st_mtime_ns):
+                        self.conn.execute("UPDATE files SET generation = ? WHERE id = ?", (generation, row[0]))
+                        unchanged += 1
+                        continue
+
+                    with open(path, 'r', encoding='utf-8', errors='replace') as f:
+                        text = f.read()
+
+                    if row is None:
+                        cursor = self.conn.execute(
+                            "INSERT INTO files (path, size, mtime_ns, generation) VALUES (?, ?, ?, ?)",
+                            (path, stat.st_size, stat.st_mtime_ns, generation),
+                        )
+                        file_id = cursor.lastrowid
+                    else:
+                        file_id = row[0]
+                        self.conn.execute(
+                            "UPDATE files SET size = ?, mtime_ns = ?, generation = ? WHERE id = ?",
+                            (stat.st_size, stat.st_mtime_ns, generation, file_id),
+                        )
+                        self.conn.execute("DELETE FROM page_text WHERE rowid = ?", (file_id,))
+                    self.conn.execute("INSERT INTO page_text (rowid, text) VALUES (?, ?)", (file_id, text))
+                    indexed += 1
+
+            # Files not seen in this walk were deleted
+            stale = [row[0] for row in self.conn.execute("SELECT id FROM files WHERE generation < ?", (generation,))]
+            self.conn.executemany("DELETE FROM page_text WHERE rowid = ?", [(file_id,) for file_id in stale])
+            self.conn.execute("DELETE FROM files WHERE generation < ?", (generation,))
+
+        print(f"Text index: {indexed} file(s) indexed, {unchanged} unchanged, {len(stale)} removed")
+
+    def update_entities(self, entity_file, batch_size=10000):
+        """Load the entities of an NER output file, replacing what was loaded from it before, if it changed."""
+        source = os.path.normpath(entity_file)
+        stat = os.stat(source)
+        row = self.conn.execute("SELECT size, mtime_ns FROM entity_sources WHERE path = ?", (source,)).fetchone()
+        if row is not None and tuple(row) == (stat.st_size, stat.st_mtime_ns):
+            print(f"Entities: {source} unchanged")
+            return
+
+        loaded = 0
+        with self.conn:
+            self.conn.execute("DELETE FROM entities WHERE source = ?", (source,))
+            batch = []
+            for entity in read_entities(source):
+                batch.append((entity.entity, normalize_entity(entity.entity), entity.label,
+                              os.path.normpath(entity.file_path), entity.start_char, entity.end_char, source))
+                if len(batch) == batch_size:
+                    self.insert_entities(batch)
+                    loaded += len(batch)
+                    batch = []
+            if batch:
+                self.insert_entities(batch)
+                loaded += len(batch)
+            self.conn.execute(
+                "INSERT OR REPLACE INTO entity_sources (path, size, mtime_ns) VALUES (?, ?, ?)",
+                (source, stat.st_size, stat.st_mtime_ns),
+            )
+
+        print(f"Entities: {loaded} loaded from {source}")
+
+    def remove_entity_sources(self, keep):
+        """Drop the entities of every entity file loaded before that is not in keep, e.g. deleted or replaced files."""
+        keep = {os.path.normpath(path) for path in keep}
+        stale = [row[0] for row in self.conn.execute("SELECT path FROM entity_sources") if row[0] not in keep]
+        with self.conn:
+            for source in stale:
+                self.conn.execute("DELETE FROM entities WHERE source = ?", (source,))
+                self.conn.execute("DELETE FROM entity_sources WHERE path = ?", (source,))
+        if stale:
+            print(f"Entities: {len(stale)} source(s) no longer in the build removed")
+
+    def insert_entities(self, rows):
+        self.conn.executemany(
+            "INSERT INTO entities (entity, entity_norm, label, file_path, start_char, end_char, source) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            rows,
+        )
+
+    def find_entity(self, name, label=None, limit=1000):
+        """Return (file path, start, end, label) of every mention of the entity name.
+
+        A mention loaded from more than one entity file is returned once.
+        """
+        query = "SELECT DISTINCT file_path, start_char, end_char, label FROM entities WHERE entity_norm = ?"
+        params = [normalize_entity(name)]
+        if label:
+            query += " AND label = ?"
+            params.append(label)
+        query += " ORDER BY file_path, start_char LIMIT ?"
+        params.append(limit)
+        return self.conn.execute(query, params).fetchall()
+
+    def entities_with_label(self, label, limit=100):
+        """Return the most mentioned entities with the label, as (entity, mentions, files)."""
+        return self.conn.execute(
+            "SELECT MIN(entity), COUNT(DISTINCT file_path || ':' || start_char || ':' || end_char) AS mentions, "
+            "COUNT(DISTINCT file_path) FROM entities WHERE label = ? "
+            "GROUP BY entity_norm ORDER BY mentions DESC LIMIT ?",
+            (label, limit),
+        ).fetchall()
+
+    def search_phrase(self, phrase, limit=100):
+        """Return (file path, snippet) of the pages containing the exact phrase."""
+        fts_query = '"' + phrase.replace('"', '""') + '"'
+        return self.conn.execute(
+            "SELECT files.path, snippet(page_text, 0, '[', ']', '...', 12) FROM page_text "
+            "JOIN files ON files.id = page_text.rowid WHERE page_text MATCH ? ORDER BY rank LIMIT ?",
+            (fts_query, limit),
+        ).fetchall()
+
+    def close(self):
+        self.conn.close()
+
+def default_entity_files(entity_directory="./output_entities", include_jobs=False):
+    """Return the entity files to index when none are given.
+
+    These are the per-PDF files the pipeline writes under <engine>/<subfolder>/ or, if there are none, the
+    outputs of the spaCy and Hugging Face scripts. Only one of the two is used so that a corpus processed
+    both ways is not indexed twice. NER worker job files are only added with include_jobs, as each
+    resubmitted job writes a new file.
+    """
+    nested_files = sorted(glob.glob(os.path.join(glob.escape(entity_directory), "*", "*", "*.jsonl")))
+    job_files = [path for path in nested_files if os.path.basename(os.path.dirname(path)) == "jobs"]
+    entity_files = [path for path in nested_files if path not in job_files]
+    if not entity_files:
+        entity_files = [
+            os.path.join(entity_directory, "entities_by_type.jsonl"),
+            os.path.join(entity_directory, "entities_by_type_huggingface.jsonl"),
+        ]
+    return entity_files + (job_files if include_jobs else [])
+
+def main():
+    parser = argparse.ArgumentParser(description="Build and query the entity and full-text index of the OCR corpus.")
+    parser.add_argument("--db", default="./entity_index.sqlite", help="Index database")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    build_parser = subparsers.add_parser("build", help="Update the index with new and changed files")
+    build_parser.add_argument("--text", default="./output_text", help="Directory of OCR text files")
+    build_parser.add_argument("--entities", nargs="*", default=None,
+                              help="Entity output files (default: the pipeline's outputs under ./output_entities, "
+                                   "or the spaCy and Hugging Face script outputs if there are none)")
+    build_parser.add_argument("--include-jobs", action="store_true",
+                              help="Also index the NER worker job files when --entities is not given")
+
+    entity_parser = subparsers.add_parser("entity", help="Find the mentions of an entity")
+    entity_parser.add_argument("name")
+    entity_parser.add_argument("--label", default=None)
+    entity_parser.add_argument("--limit", type=int, default=1000)
+
+    label_parser = subparsers.add_parser("label", help="List the most mentioned entities with a label")
+    label_parser.add_argument("label")
+    label_parser.add_argument("--limit", type=int, default=100)
+
+    phrase_parser = subparsers.add_parser("phrase", help="Find the pages containing a phrase")
+    phrase_parser.add_argument("phrase")
+    phrase_parser.add_argument("--limit", type=int, default=100)
+
+    args = parser.parse_args()
+    index = EntityIndex(args.db)
+    start_time = time.perf_counter()
+
+    if args.command == "build":
+        index.update_text(args.text)
+        entity_files = args.entities if args.entities is not None else default_entity_files(include_jobs=args.include_jobs)
+        loaded_files = []
+        for entity_file in entity_files:
+            if os.path.exists(entity_file):
+                index.update_entities(entity_file)
+                loaded_files.append(entity_file)
+            else:
+                print(f"Entities: {entity_file} not found, skipping")
+        index.remove_entity_sources(loaded_files)
+
+    elif args.command == "entity":
+        for file_path, start_char, end_char, label in index.find_entity(args.name, args.label, args.limit):
+            print(f"{file_path}\t{label}\t({start_char}, {end_char})")
+
+    elif args.command == "label":
+        for entity, mentions, files in index.entities_with_label(args.label, args.limit):
+            print(f"{entity}\t{mentions} mention(s) in {files} file(s)")
+
+    elif args.command == "phrase":
+        for file_path, snippet in index.search_phrase(args.phrase, args.limit):
+            print(f"{file_path}\t{' '.join(snippet.split())}")
+
+    elapsed_ms = (time.perf_counter() - start_time) * 1000
+    print(f"({elapsed_ms:.1f} ms)")
+    index.close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,191 @@
+import re
+import zlib
+import json
+import argparse
+from collections import Counter, defaultdict
+from entity_sink import read_entities
+
+soundex_codes = {}
+for letters, code in (("BFPV", "1"), ("CGJKQSXZ", "2"), ("DT", "3"), ("L", "4"), ("MN", "5"), ("R", "6")):
+    for letter in letters:
+        soundex_codes[letter] = code
+
+def soundex(word):
+    """Return the American Soundex code of a word, e.g. FREEMAN and FREYMAN both give F655."""
+    word = re.sub(r"[^A-Z]", "", word.upper())
+    if not word:
+        return ""
+    code = word[0]
+    previous = soundex_codes.get(word[0], "")
+    for letter in word[1:]:
+        digit = soundex_codes.get(letter, "")
+        if digit and digit != previous:
+            code += digit
+        if letter not in "HW":
+            previous = digit
+    return (code + "000")[:4]
+
+def jaro_winkler(first, second, prefix_scale=0.1):
+    """Return the Jaro-Winkler similarity of two strings, between 0 and 1."""
+    if first == second:
+        return 1.0
+    if not first or not second:
+        return 0.0
+
+    window = max(0, max(len(first), len(second)) // 2 - 1)
+    first_matched = [False] * len(first)
+    second_matched = [False] * len(second)
+    matches = 0
+    for i, char in enumerate(first):
+        for j in range(max(0, i - window), min(len(second), i + window + 1)):
+            if not second_matched[j] and second[j] == char:
+                first_matched[i] = second_matched[j] = True
+                matches += 1
+                break
+    if matches == 0:
+        return 0.0
+
+    first_chars = [char for char, matched in zip(first, first_matched) if matched]
+    second_chars = [char for char, matched in zip(second, second_matched) if matched]
+    transpositions = sum(a != b for a, b in zip(first_chars, second_chars)) / 2
+
+    jaro = (matches / len(first) + matches / len(second) + (matches - transpositions) / matches) / 3
+
+    prefix = 0
+    for a, b in zip(first[:4], second[:4]):
+        if a != b:
+            break
+        prefix += 1
+    return jaro + prefix * prefix_scale * (1 - jaro)
+
+def normalize_name(text):
+    """Upper-case a name and collapse whitespace, so trivial differences don't count as variants."""
+    return " ".join(text.split()).upper()
+
+def blocking_keys(name, ngram_keys=2):
+    """Return the keys of the blocks a name is put in; only names sharing a block are compared.
+
+    One key combines the first initial with the Soundex code of the last word, which catches OCR
+    misspellings of a surname. The others are the name's rarest-looking character trigrams (the
+    smallest by hash, as in MinHash), which catch variants whose first letters differ.
+    """
+    tokens = name.split()
+    keys = set()
+    if tokens:
+        keys.add(f"s:{tokens[0][0]}:{soundex(tokens[-1])}")
+
+    compact = name.replace(" ", "")
+    trigrams = {compact[i:i + 3] for i in range(len(compact) - 2)}
+    for trigram in sorted(trigrams, key=lambda gram: zlib.crc32(gram.encode("utf-8")))[:ngram_keys]:
+        keys.add(f"g:{trigram}")
+    return keys
+
+class UnionFind:
+    def __init__(self):
+        self.parent = {}
+
+    def find(self, item):
+        self.parent.setdefault(item, item)
+        root = item
+        while self.parent[root] != root:
+            root = self.parent[root]
+        while self.parent[item] != root:
+            self.parent[item], item = root, self.parent[item]
+        return root
+
+    def union(self, first, second):
+        first_root, second_root = self.find(first), self.find(second)
+        if first_root != second_root:
+            self.parent[second_root] = first_root
+
+def count_mentions(entity_files, labels):
+    """Count the mentions of each normalized name, and the most common spelling of it, over all entity files."""
+    mentions = Counter()
+    spellings = defaultdict(Counter)
+    for entity_file in entity_files:
+        for entity in read_entities(entity_file):
+            if labels and entity.label not in labels:
+                continue
+            name = normalize_name(entity.entity)
+            if len(name) < 3:
+                continue
+            mentions[name] += 1
+            spellings[name][" ".join(entity.entity.split())] += 1
+    return mentions, {name: counter.most_common(1)[0][0] for name, counter in spellings.items()}
+
+def resolve(mentions, threshold=0.92, max_block_size=500):
+    """Cluster the names whose similarity reaches the threshold, comparing only names that share a block.
+
+    Blocks bigger than max_block_size are skipped, as keys that common say nothing about a match; this
+    keeps the number of comparisons close to linear in the number of distinct names.
+    """
+    keys_of = {}
+    blocks = defaultdict(list)
+    for name in mentions:
+        keys_of[name] = blocking_keys(name)
+        for key in keys_of[name]:
+            blocks[key].append(name)
+
+    oversized = {key for key, members in blocks.items() if len(members) > max_block_size}
+
+    clusters = UnionFind()
+    comparisons = 0
+    for key, members in blocks.items():
+        if key in oversized:
+            continue
+        for i, first in enumerate(members):
+            for second in members[i + 1:]:
+                # Names sharing several blocks are compared only in the first of them, so nothing needs
+                # to remember which pairs were already compared
+                if min(keys_of[first] & keys_of[second] - oversized) != key:
+                    continue
+                if clusters.find(first) == clusters.find(second):
+                    continue
+                comparisons += 1
+                if jaro_winkler(first, second) >= threshold:
+                    clusters.union(first, second)
+
+    print(f"Compared {comparisons} pairs in {len(blocks)} blocks ({len(oversized)} oversized blocks skipped) "
+          f"for {len(mentions)} distinct names")
+
+    grouped = defaultdict(list)
+    for name in mentions:
+        grouped[clusters.find(name)].append(name)
+    # The most mentioned spelling of a cluster is taken to be the correct one
+    return [sorted(names, key=lambda name: (-mentions[name], name)) for names in grouped.values() if len(names) > 1]
+
+def main():
+    parser = argparse.ArgumentParser(description="Cluster spelling variants of the entities found by the NER scripts.")
+    parser.add_argument("entity_files", nargs="+", help="Entity output files (text, JSONL or Parquet)")
+    parser.add_argument("--labels", nargs="*", default=["PERSON", "PER", "B-PER", "I-PER"],
+                        help="Entity labels to resolve; pass no value to use every label")
+    parser.add_argument("--threshold", type=float, default=0.92, help="Minimum Jaro-Winkler similarity of a match")
+    parser.add_argument("--max-block-size", type=int, default=500)
+    parser.add_argument("--output", default="./output_entities/entity_clusters.jsonl")
+    parser.add_argument("--suggest-rules", default=None,
+                        help="Also write candidate typos.py rules (typo_rules.tsv format) to this file")
+    args = parser.parse_args()
+
+    mentions, spellings = count_mentions(args.entity_files, set(args.labels))
+    clusters = resolve(mentions, args.threshold, args.max_block_size)
+    clusters.sort(key=lambda names: -sum(mentions[name] for name in names))
+
+    with open(args.output, 'w', encoding='utf-8') as f:
+        for names in clusters:
+            f.write(json.dumps({
+                "canonical": spellings[names[0]],
+                "variants": [{"name": spellings[name], "mentions": mentions[name]} for name in names],
+            }, ensure_ascii=False) + "\n")
+    print(f"Wrote {len(clusters)} clusters to {args.output}")
+
+    if args.suggest_rules:
+        with open(args.suggest_rules, 'w', encoding='utf-8') as f:
+            f.write("# Suggested by entity_resolution.py; review before adding to typo_rules.tsv\n")
+            for names in clusters:
+                canonical = spellings[names[0]]
+                for name in names[1:]:
+                    f.write(f"literal\t{spellings[name]}\t{canonical}\n")
+        print(f"Wrote suggested rules to {args.suggest_rules}")
+
+if __name__ == "__main__":
+    main()
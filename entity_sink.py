@@ -0,0 +1,129 @@
+import os
+import re
+import json
+from collections import namedtuple
+
+# Compact record for one entity mention; a tuple instead of a dict per entity
+Entity = namedtuple("Entity", ["entity", "label", "file_path", "start_char", "end_char"])
+
+legacy_line_pattern = re.compile(r"^Entity: (.*), Label: (.*), File: (.*), Position: \((\d+), (\d+)\)$")
+
+class TextSink:
+    """Writes entities in the original free-text format, one line per entity."""
+
+    def __init__(self, output_file):
+        self.file = open(output_file, 'w', encoding='utf-8')
+
+    def write(self, entities):
+        for entity in entities:
+            self.file.write(f"Entity: {entity.entity}, Label: {entity.label}, "
+                            f"File: {entity.file_path}, "
+                            f"Position: ({entity.start_char}, {entity.end_char})\n")
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+class JsonlSink:
+    """Writes one JSON object per entity."""
+
+    def __init__(self, output_file):
+        self.file = open(output_file, 'w', encoding='utf-8')
+
+    def write(self, entities):
+        for entity in entities:
+            self.file.write(json.dumps(entity._asdict(), ensure_ascii=False))
+            self.file.write("\n")
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+class ParquetSink:
+    """Writes entities to a Parquet file, one row group per row_group_size entities.
+
+    Only the current row group is held in memory, column by column. Labels and file paths repeat
+    heavily and are dictionary-encoded by the Parquet writer.
+    """
+
+    def __init__(self, output_file, row_group_size=100000):
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError:
+            raise ImportError("Parquet output requires pyarrow: pip install pyarrow")
+
+        self.pa = pa
+        self.schema = pa.schema([
+            ("entity", pa.string()),
+            ("label", pa.string()),
+            ("file_path", pa.string()),
+            ("start_char", pa.int64()),
+            ("end_char", pa.int64()),
+        ])
+        self.writer = pq.ParquetWriter(output_file, self.schema, compression="zstd")
+        self.row_group_size = row_group_size
+        self.columns = [[] for _ in Entity._fields]
+
+    def write(self, entities):
+        for entity in entities:
+            for column, value in zip(self.columns, entity):
+                column.append(value)
+        if len(self.columns[0]) >= self.row_group_size:
+            self.flush()
+
+    def flush(self):
+        if not self.columns[0]:
+            return
+        table = self.pa.Table.from_arrays([self.pa.array(column) for column in self.columns], schema=self.schema)
+        self.writer.write_table(table)
+        self.columns = [[] for _ in Entity._fields]
+
+    def close(self):
+        self.flush()
+        self.writer.close()
+
+sink_formats = {
+    "text": TextSink,
+    "jsonl": JsonlSink,
+    "parquet": ParquetSink,
+}
+
+def guess_format(path):
+    """Pick the output format from the file extension."""
+    extension = os.path.splitext(path)[1].lower()
+    return {".jsonl": "jsonl", ".parquet": "parquet"}.get(extension, "text")
+
+def open_sink(output_file, output_format=None):
+    """Create the output directory and open a sink of the given format (guessed from the extension if None)."""
+    directory = os.path.dirname(output_file)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    return sink_formats[output_format or guess_format(output_file)](output_file)
+
+def read_entities(path, input_format=None):
+    """Yield the entities stored in a file written by any of the sinks, one record at a time."""
+    input_format = input_format or guess_format(path)
+
+    if input_format == "parquet":
+        import pyarrow.parquet as pq
+        parquet_file = pq.ParquetFile(path)
+        for batch in parquet_file.iter_batches():
+            columns = [batch.column(name).to_pylist() for name in Entity._fields]
+            for row in zip(*columns):
+                yield Entity(*row)
+        return
+
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            line = line.rstrip("\n")
+            if not line:
+                continue
+            if input_format == "jsonl":
+                record = json.loads(line)
+                yield Entity(**record)
+            else:
+                match = legacy_line_pattern.match(line)
+                if match:
+                    entity, label, file_path, start_char, end_char = match.groups()
+                    yield Entity(entity, label, file_path, int(start_char), int(end_char))
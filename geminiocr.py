@@ -1,13 +1,25 @@
+import io
 import os
+import re
 import sys
 import google.generativeai as genai
 import json
 import csv
+import difflib
 import traceback
 import logging
-from datetime import datetime
+import threading
+import time
+from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
 from google.protobuf.json_format import MessageToDict
+from PIL import Image
 from google.generativeai.types.generation_types import StopCandidateException
+from ratelimit import RateLimiter, call_with_retry, is_retryable_error
+from ocr_cache import OCRCache, make_cache_key
+from preprocess import preprocess_bytes, report_savings
+from metrics import metrics
+from cleanupgeminifiles import start_background_cleanup
 
 # Configuration for the model
 generation_config = {
@@ -18,8 +30,10 @@ generation_config = {
     "response_mime_type": "text/plain",
 }
 
+model_name = "gemini-1.5-flash"
+
 model = genai.GenerativeModel(
-    model_name="gemini-1.5-flash",
+    model_name=model_name,
     generation_config=generation_config,
 )
 
@@ -35,10 +49,57 @@ logging.basicConfig(
     ]
 )
 
+ocr_prompt = "Please convert the content of this image to plain text. Do not include unnecessary line breaks or newlines."
+
+finish_reason_dict = {
+    0: "Unspecified reason",
+    1: "Natural stop (STOP)",
+    2: "Max tokens reached (MAX_TOKENS)",
+    3: "Safety concern (SAFETY)",
+    4: "Recitation detected (RECITATION)",
+    5: "Unknown reason (OTHER)"
+}
+
+tile_prompt = (
+    "This image is a horizontal strip cut from a larger page. Please convert its content to plain text, "
+    "keeping one output line per line of text in the image, including partially visible lines at the edges."
+)
+
+# Dense pages that hit MAX_TOKENS are processed again as overlapping horizontal tiles
+tile_settings = {
+    "enabled": True,
+    "tiles": 3,        # Number of strips the page is cut into
+    "overlap": 0.15,   # Fraction of a strip repeated in the neighbouring strips
+    "max_depth": 2,    # How many times a tile that still hits MAX_TOKENS is split again
+}
+
+batch_prompt = (
+    "You will receive {page_count} page images. Convert the content of each image to plain text. "
+    "Do not include unnecessary line breaks or newlines. Before the text of each page, write a line "
+    "containing only '=== PAGE n ===' where n is the page number given before the image, and output "
+    "the pages in order."
+)
+
+batch_marker_pattern = re.compile(r"^=== PAGE (\d+) ===[ \t]*$", re.MULTILINE)
+
+# Uploads are named with this prefix. Uploads older than orphan_cleanup["min_age_hours"] belong to runs that
+# crashed before deleting them, and are deleted in the background while OCR runs in upload mode.
+upload_display_prefix = "carl-ocr-"
+orphan_cleanup = {
+    "enabled": True,
+    "min_age_hours": 2,
+    "interval_minutes": 30,
+    "workers": 4,
+}
+
+# Worker threads append to the same CSV file
+csv_lock = threading.Lock()
+
 def log_unfinished_file_csv(csv_path, file_path, finish_reason):
-    with open(csv_path, "a", newline='') as csvfile:
-        log_writer = csv.writer(csvfile)
-        log_writer.writerow([file_path, finish_reason])
+    with csv_lock:
+        with open(csv_path, "a", newline='') as csvfile:
+            log_writer = csv.writer(csvfile)
+            log_writer.writerow([file_path, finish_reason])
 
 def load_unfinished_files(csv_path):
     unfinished_files = set()
@@ -50,10 +111,11 @@ def load_unfinished_files(csv_path):
                     unfinished_files.add(row[0])  # Assuming the file path is the first column
     return unfinished_files
 
-def upload_to_gemini(path, mime_type=None):
+def upload_to_gemini(path, mime_type=None, display_name=None):
     """Uploads the given file to Gemini and returns the file metadata."""
     try:
-        file = genai.upload_file(path, mime_type=mime_type)
+        file = call_with_retry(genai.upload_file, path, mime_type=mime_type, display_name=display_name,
+                               description=f"upload of {path}")
         logging.info(f"Uploaded file '{file.display_name}' as: {file.uri}")
         return file
     except Exception as e:
@@ -64,129 +126,473 @@ def delete_gemini_file(file_uri):
     """Deletes a file from Gemini AI using its URI."""
     try:
         file_id = file_uri.split('/')[-1]
-        genai.delete_file(file_id)
+        with metrics.timer("delete", file_uri):
+            call_with_retry(genai.delete_file, file_id, description=f"delete of {file_uri}")
         logging.info(f"Deleted file with URI: {file_uri}")
     except Exception as e:
         logging.error(f"Failed to delete file with URI {file_uri}: {e}")
 
-def process_images(directory, output_directory, unfinished_files, csv_path):
-    """Recursively process each .png file in the directory and subdirectories, send it to Gemini, and save the text output."""
-    
-    finish_reason_dict = {
-        0: "Unspecified reason",
-        1: "Natural stop (STOP)",
-        2: "Max tokens reached (MAX_TOKENS)",
-        3: "Safety concern (SAFETY)",
-        4: "Recitation detected (RECITATION)",
-        5: "Unknown reason (OTHER)"
-    }
-
-    total_files = 0  
-    processed_files = 0  
-    
-    for root, _, files in os.walk(directory):
-        text_root = os.path.join(output_directory, os.path.relpath(root, directory))
-        os.makedirs(text_root, exist_ok=True)
-
-        image_files = sorted([f for f in files if f.endswith('.png')])
-        total_files += len(image_files)
-        logging.info(f"Processing {len(image_files)} files in directory: {root}")
-
-        for image_file in image_files:
-            output_file = os.path.join(text_root, f"{image_file[:-4]}.txt")
-            
-            if os.path.exists(output_file):
-                continue
+def save_text(output_file, extracted_text):
+    with open(output_file, "w") as f:
+        f.write(extracted_text)
+    logging.info(f"Saved text output to {output_file}")
+
+def generate_with_limits(contents, description, limiter=None, estimated_tokens=0):
+    """Call generate_content within the rate limits, retrying throttling and server errors."""
+    def generate():
+        # Every attempt, including retries, has to fit into the rate limits
+        if limiter is not None:
+            limiter.acquire(estimated_tokens)
+        return model.generate_content(contents)
+
+    start = time.perf_counter()
+    response = call_with_retry(generate, description=f"generate_content for {description}")
+    elapsed = time.perf_counter() - start
+
+    usage = response.usage_metadata
+    if usage:
+        metrics.count("input_tokens", usage.prompt_token_count)
+        metrics.count("output_tokens", usage.candidates_token_count)
+        metrics.record("generate", elapsed, description,
+                       input_tokens=usage.prompt_token_count, output_tokens=usage.candidates_token_count)
+    else:
+        metrics.record("generate", elapsed, description)
+
+    if limiter is not None and usage:
+        limiter.settle(estimated_tokens, usage.total_token_count)
+
+    return response
+
+def load_image(image_path, preprocess_config=None):
+    """Read an image from disk, preprocessing it if configured. Returns the bytes and MIME type."""
+    with open(image_path, "rb") as f:
+        image_bytes = f.read()
+
+    if preprocess_config is None:
+        return image_bytes, "image/png"
+
+    processed_bytes, mime_type = preprocess_bytes(image_bytes, preprocess_config)
+    logging.info(report_savings(image_path, len(image_bytes), len(processed_bytes)))
+    return processed_bytes, mime_type
+
+def prepare_image_part(image_path, image_bytes, transfer_mode, mime_type="image/png", upload_from_path=False):
+    """Return the content part for an image and the uploaded file to delete afterwards, if any."""
+    if transfer_mode == "inline":
+        # Inline bytes travel with the request, saving the upload and delete round trips
+        return {"mime_type": mime_type, "data": image_bytes}, None
+
+    # Pages rendered in memory or preprocessed have no matching file on disk, so upload their bytes directly
+    source = image_path if upload_from_path else io.BytesIO(image_bytes)
+    with metrics.timer("upload", image_path):
+        # The display name prefix lets the orphan cleanup tell this script's uploads apart from other files
+        uploaded_file = upload_to_gemini(source, mime_type=mime_type,
+                                         display_name=f"{upload_display_prefix}{os.path.basename(image_path)}")
+    return uploaded_file, uploaded_file
+
+def ocr_image(image_path, output_file, csv_path, limiter=None, estimated_tokens=0, cache=None, transfer_mode="upload",
+              image_bytes=None, mime_type="image/png", preprocess_config=None, cache_checked=False):
+    """Send a single image to Gemini and save the text output. Returns True if text was saved.
+
+    When image_bytes is given the image is not read from disk and image_path only identifies the page.
+    cache_checked skips the cache lookup for callers that already missed; the text is still cached.
+    """
+    logging.info(f"Processing: {image_path}")
+
+    upload_from_path = image_bytes is None and preprocess_config is None
+    if image_bytes is None:
+        image_bytes, mime_type = load_image(image_path, preprocess_config)
+
+    # Identical pages anywhere in the tree share one cache entry
+    cache_key = None
+    if cache is not None:
+        cache_key = make_cache_key(image_bytes, model_name, ocr_prompt, generation_config)
+        cached_text = None if cache_checked else cache.get(cache_key)
+        if cached_text is not None:
+            logging.info(f"Cache hit for {image_path}")
+            metrics.count("cache_hits")
+            save_text(output_file, cached_text)
+            return True
+
+    image_part, uploaded_file = prepare_image_part(image_path, image_bytes, transfer_mode, mime_type, upload_from_path)
+    if image_part is None:
+        return False
+
+    extracted_text = ""
+    response = None
+    error_handled = False
 
-            image_path = os.path.join(root, image_file)
+    try:
+        logging.info(f"Sending content for {image_path}")
 
-            if image_path in unfinished_files:
-                continue
+        response = generate_with_limits([image_part, "\n\n", ocr_prompt], image_path, limiter, estimated_tokens)
+
+        logging.info(f"Response received for {image_path}")
+
+        if response.candidates and len(response.candidates) > 0:
+            candidate = response.candidates[0]
+            finish_reason = candidate.finish_reason
+            reason_text = finish_reason_dict.get(finish_reason, f"Unknown finish reason ({finish_reason})")
+
+            logging.info(f"Finish reason for {image_path}: {reason_text}")
+
+            if finish_reason == 2 and tile_settings["enabled"]:  # Max tokens reached
+                logging.info(f"Max tokens reached for {image_path}, processing the page in tiles.")
+                logging.info(f"Token data {response.usage_metadata}")
+                extracted_text = ocr_tiled(image_path, image_bytes, limiter, estimated_tokens) or ""
+                if not extracted_text:
+                    log_unfinished_file_csv(csv_path, image_path, reason_text)
+
+            elif finish_reason != 1:  # Not successful
+                log_unfinished_file_csv(csv_path, image_path, reason_text)
+
+            if finish_reason == 1:  # Successful
+                extracted_text += candidate.content.parts[0].text
+        else:
+            logging.warning(f"Failed to extract text for {image_path}. No valid candidates returned.")
+            log_unfinished_file_csv(csv_path, image_path, "No valid candidates returned")
+            error_handled = True
 
-            logging.info(f"Processing: {image_path}")
+    except StopCandidateException as sce:
+        candidate = sce.args[0]
+        finish_reason = candidate.finish_reason
+        reason_text = finish_reason_dict.get(finish_reason, f"Unknown finish reason ({finish_reason})")
 
-            uploaded_file = upload_to_gemini(image_path, mime_type="image/png")
-            if uploaded_file is None:
+        logging.info(f"Handled StopCandidateException for {image_path}: {sce}")
+        log_unfinished_file_csv(csv_path, image_path, reason_text)
+        error_handled = True
+
+    except Exception as e:
+        error_handled = True
+        if is_retryable_error(e):
+            # Throttling and server errors are not the page's fault, so leave it for the next run
+            logging.error(f"Giving up on {image_path} after repeated retryable errors: {e}")
+        else:
+            logging.error(f"An error occurred while processing {image_path}: {e}")
+            logging.error(traceback.format_exc())
+            log_unfinished_file_csv(csv_path, image_path, f"Unexpected error: {e}")
+
+    saved = False
+    if not error_handled and extracted_text:
+        save_text(output_file, extracted_text)
+        logging.info(extracted_text)
+        if cache is not None:
+            cache.put(cache_key, extracted_text)
+        saved = True
+    else:
+        logging.warning(f"No text extracted for {image_path}")
+
+    if uploaded_file is not None:
+        delete_gemini_file(uploaded_file.uri)
+    return saved
+
+def split_into_tiles(image_bytes, tile_count, overlap):
+    """Split an image into tile_count horizontal strips that overlap by the given fraction of a strip."""
+    with Image.open(io.BytesIO(image_bytes)) as image:
+        image.load()
+        strip_height = image.height / tile_count
+        margin = int(strip_height * overlap)
+        tiles = []
+        for index in range(tile_count):
+            top = max(0, int(index * strip_height) - margin)
+            bottom = min(image.height, int((index + 1) * strip_height) + margin)
+            buffer = io.BytesIO()
+            image.crop((0, top, image.width, bottom)).save(buffer, 'PNG')
+            tiles.append(buffer.getvalue())
+    return tiles
+
+def lines_match(first, second, min_similarity):
+    first = " ".join(first.split())
+    second = " ".join(second.split())
+    if first == second:
+        return True
+    # A line cut off at a tile edge often comes back as the start of the full line
+    shorter, longer = sorted((first, second), key=len)
+    if len(shorter) >= 5 and longer.startswith(shorter):
+        return True
+    return difflib.SequenceMatcher(None, first, second).ratio() >= min_similarity
+
+def find_line_overlap(previous, following, max_lines, min_similarity):
+    """Find lines repeated where two tiles overlap.
+
+    Returns (trim, count): the last trim lines of previous are a cut-off line that following repeats in
+    full, and the first count lines of following duplicate the end of previous.
+    """
+    for trim in (0, 1):
+        available = len(previous) - trim
+        for count in range(min(available, len(following), max_lines), 0, -1):
+            overlap = list(zip(previous[available - count:available], following[:count]))
+            if not any(a.strip() for a, _ in overlap):
+                continue  # Blank lines alone don't prove an overlap
+            if all(lines_match(a, b, min_similarity) for a, b in overlap):
+                return trim, count
+    return 0, 0
+
+def stitch_tile_texts(texts, max_overlap_lines=10, min_similarity=0.85):
+    """Join the text of consecutive tiles, dropping the lines duplicated where the tiles overlap."""
+    lines = texts[0].splitlines()
+    for text in texts[1:]:
+        following = text.splitlines()
+        trim, count = find_line_overlap(lines, following, max_overlap_lines, min_similarity)
+        lines = lines[:len(lines) - trim]
+        # Of two matching lines, the longer one is the one not cut off at a tile edge
+        start = len(lines) - count
+        for offset in range(count):
+            if len(following[offset]) > len(lines[start + offset]):
+                lines[start + offset] = following[offset]
+        lines.extend(following[count:])
+    return "\n".join(lines)
+
+def ocr_tiled(image_path, image_bytes, limiter=None, estimated_tokens=0, depth=0):
+    """OCR a dense page as overlapping tiles processed concurrently, and stitch the text back together.
+
+    Tiles that hit MAX_TOKENS again are split further, up to tile_settings["max_depth"] levels.
+    Returns None if any tile could not be processed.
+    """
+    tiles = split_into_tiles(image_bytes, tile_settings["tiles"], tile_settings["overlap"])
+
+    def ocr_tile(index, tile_bytes):
+        label = f"{image_path} tile {index + 1}/{len(tiles)}"
+        try:
+            response = generate_with_limits([{"mime_type": "image/png", "data": tile_bytes}, "\n\n", tile_prompt],
+                                            label, limiter, estimated_tokens)
+        except StopCandidateException as sce:
+            logging.info(f"Handled StopCandidateException for {label}: {sce}")
+            return None
+        except Exception as e:
+            logging.error(f"An error occurred while processing {label}: {e}")
+            return None
+
+        if not response.candidates:
+            logging.warning(f"Failed to extract text for {label}. No valid candidates returned.")
+            return None
+
+        candidate = response.candidates[0]
+        if candidate.finish_reason == 1:
+            return candidate.content.parts[0].text
+        if candidate.finish_reason == 2 and depth < tile_settings["max_depth"]:
+            logging.info(f"Max tokens reached for {label}, splitting it further.")
+            return ocr_tiled(label, tile_bytes, limiter, estimated_tokens, depth + 1)
+
+        logging.warning(f"Finish reason for {label}: {finish_reason_dict.get(candidate.finish_reason, candidate.finish_reason)}")
+        return None
+
+    with ThreadPoolExecutor(max_workers=len(tiles)) as executor:
+        texts = list(executor.map(ocr_tile, range(len(tiles)), tiles))
+
+    if any(text is None for text in texts):
+        return None
+    return stitch_tile_texts(texts)
+
+def split_batch_response(text, page_count):
+    """Split a batch response into per-page texts, or return None if the page markers don't line up."""
+    parts = batch_marker_pattern.split(text)
+    # split() yields the text before the first marker, then alternating page numbers and page texts
+    if len(parts) != 2 * page_count + 1 or parts[0].strip():
+        return None
+    page_numbers = [int(number) for number in parts[1::2]]
+    if page_numbers != list(range(1, page_count + 1)):
+        return None
+    return [page_text.strip() for page_text in parts[2::2]]
+
+def ocr_batch(pages, csv_path, limiter=None, estimated_tokens=0, cache=None, transfer_mode="inline", preprocess_config=None):
+    """Send several images to Gemini in one request and split the result into per-page text outputs.
+
+    pages is a list of (image_path, output_file) tuples. Pages of a batch whose response is truncated
+    or can't be split cleanly are sent again as single-page requests; a batch that failed with throttling
+    or server errors is left for the next run rather than adding more requests. Pages are cached under
+    the single-page key, so batch and single-page runs share results. Returns the number of pages saved.
+    """
+    saved = 0
+    batch = []
+    for image_path, output_file in pages:
+        image_bytes, mime_type = load_image(image_path, preprocess_config)
+
+        cache_key = None
+        if cache is not None:
+            cache_key = make_cache_key(image_bytes, model_name, ocr_prompt, generation_config)
+            cached_text = cache.get(cache_key)
+            if cached_text is not None:
+                logging.info(f"Cache hit for {image_path}")
+                metrics.count("cache_hits")
+                save_text(output_file, cached_text)
+                saved += 1
                 continue
 
-            extracted_text = ""
-            response = None  
-            error_handled = False  
+        batch.append((image_path, output_file, image_bytes, mime_type, cache_key))
 
+    if not batch:
+        return saved
+
+    description = f"batch of {len(batch)} pages starting at {batch[0][0]}"
+    contents = [batch_prompt.format(page_count=len(batch))]
+    uploaded_files = []
+    page_texts = None
+    throttled = False
+
+    try:
+        for page_number, (image_path, _, image_bytes, mime_type, _) in enumerate(batch, start=1):
+            image_part, uploaded_file = prepare_image_part(image_path, image_bytes, transfer_mode, mime_type)
+            if image_part is None:
+                raise RuntimeError(f"Failed to prepare {image_path}")
+            if uploaded_file is not None:
+                uploaded_files.append(uploaded_file)
+            contents.extend([f"Page {page_number}:", image_part])
+
+        logging.info(f"Sending content for {description}")
+        response = generate_with_limits(contents, description, limiter, estimated_tokens * len(batch))
+
+        if response.candidates and response.candidates[0].finish_reason == 1:
+            page_texts = split_batch_response(response.candidates[0].content.parts[0].text, len(batch))
+            if page_texts is None:
+                logging.warning(f"Could not split the response for {description}")
+        else:
+            logging.warning(f"Batch request did not finish normally for {description}")
+
+    except Exception as e:
+        logging.error(f"An error occurred while processing {description}: {e}")
+        throttled = is_retryable_error(e)
+
+    for uploaded_file in uploaded_files:
+        delete_gemini_file(uploaded_file.uri)
+
+    if throttled:
+        # The API is pushing back; single-page requests would only add load, so leave the pages for the next run
+        logging.info(f"Leaving {description} for the next run")
+        return saved
+
+    # An empty section between markers that line up is a blank page, not a failure, and is saved as such
+    if page_texts is None:
+        logging.info(f"Falling back to single-page requests for {description}")
+        for image_path, output_file, image_bytes, mime_type, _ in batch:
+            saved += ocr_image(image_path, output_file, csv_path, limiter, estimated_tokens, cache, transfer_mode,
+                               image_bytes=image_bytes, mime_type=mime_type, cache_checked=True)
+        return saved
+
+    for (image_path, output_file, _, _, cache_key), page_text in zip(batch, page_texts):
+        save_text(output_file, page_text)
+        if cache is not None:
+            cache.put(cache_key, page_text)
+        saved += 1
+
+    return saved
+
+def process_images(directory, output_directory, unfinished_files, csv_path, max_in_flight=8, limiter=None, estimated_tokens=0, cache=None,
+                   transfer_mode="upload", batch_size=1, preprocess_config=None):
+    """Recursively process each .png file in the directory and subdirectories, send it to Gemini, and save the text output.
+
+    Up to max_in_flight requests are processed concurrently by a thread pool. With a batch_size
+    above 1, that many pages are packed into each request.
+    """
+    total_files = 0
+    processed_files = 0
+
+    def collect(futures):
+        count = 0
+        for future in futures:
             try:
-                logging.info(f"Sending content for {image_path}")
+                count += future.result()
+            except Exception as e:
+                logging.error(f"Worker failed: {e}")
+        return count
 
-                response = model.generate_content(
-                    [uploaded_file, "\n\n", "Please convert the content of this image to plain text. Do not include unnecessary line breaks or newlines."]
-                )
+    with ThreadPoolExecutor(max_workers=max_in_flight) as executor:
+        pending = set()
+        batch = []
 
-                logging.info(f"Response received for {image_path}")
+        def submit(task, *args):
+            nonlocal pending, processed_files
+            # Keep the queue of submitted requests short so the walk does not run far ahead of the workers
+            if len(pending) >= max_in_flight * 2:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                processed_files += collect(done)
+            pending.add(executor.submit(task, *args))
 
-                if response.candidates and len(response.candidates) > 0:
-                    candidate = response.candidates[0]
-                    finish_reason = candidate.finish_reason
-                    reason_text = finish_reason_dict.get(finish_reason, f"Unknown finish reason ({finish_reason})")
+        for root, _, files in os.walk(directory):
+            text_root = os.path.join(output_directory, os.path.relpath(root, directory))
+            os.makedirs(text_root, exist_ok=True)
 
-                    logging.info(f"Finish reason for {image_path}: {reason_text}")
+            image_files = sorted([f for f in files if f.endswith('.png')])
+            total_files += len(image_files)
+            logging.info(f"Processing {len(image_files)} files in directory: {root}")
 
-                    if finish_reason == 2:  # Max tokens reached
-                        logging.info(f"Max tokens reached for {image_path}, consider handling continuation.")
-                        logging.info(f"Token data {response.usage_metadata}")
+            for image_file in image_files:
+                output_file = os.path.join(text_root, f"{image_file[:-4]}.txt")
 
-                    if finish_reason != 1:  # Not successful
-                        log_unfinished_file_csv(csv_path, image_path, reason_text)
+                if os.path.exists(output_file):
+                    continue
 
-                    if finish_reason == 1:  # Successful
-                        extracted_text += candidate.content.parts[0].text
-                else:
-                    logging.warning(f"Failed to extract text for {image_path}. No valid candidates returned.")
-                    log_unfinished_file_csv(csv_path, image_path, "No valid candidates returned")
-                    error_handled = True
+                image_path = os.path.join(root, image_file)
 
-            except StopCandidateException as sce:
-                candidate = sce.args[0]  
-                finish_reason = candidate.finish_reason
-                reason_text = finish_reason_dict.get(finish_reason, f"Unknown finish reason ({finish_reason})")
+                if image_path in unfinished_files:
+                    continue
 
-                logging.info(f"Handled StopCandidateException for {image_path}: {sce}")
-                log_unfinished_file_csv(csv_path, image_path, reason_text)
-                error_handled = True
+                if batch_size <= 1:
+                    submit(ocr_image, image_path, output_file, csv_path, limiter, estimated_tokens, cache, transfer_mode,
+                           None, "image/png", preprocess_config)
+                    continue
 
-            except Exception as e:
-                logging.error(f"An error occurred while processing {image_path}: {e}")
-                logging.error(traceback.format_exc())  
-                log_unfinished_file_csv(csv_path, image_path, f"Unexpected error: {e}")
-                error_handled = True  
-
-                if "429" in str(e):
-                    logging.error(f"Rate limit error for {image_path}. Exiting.")
-                    sys.exit()
-
-            if not error_handled and extracted_text:
-                with open(output_file, "w") as f:
-                    f.write(extracted_text)
-                logging.info(f"Saved text output to {output_file}")
-                logging.info(extracted_text)
-                processed_files += 1
-            else:
-                logging.warning(f"No text extracted for {image_path}")
-
-            delete_gemini_file(uploaded_file.uri)
+                batch.append((image_path, output_file))
+                if len(batch) == batch_size:
+                    submit(ocr_batch, batch, csv_path, limiter, estimated_tokens, cache, transfer_mode, preprocess_config)
+                    batch = []
+
+        if batch:
+            submit(ocr_batch, batch, csv_path, limiter, estimated_tokens, cache, transfer_mode, preprocess_config)
+
+        processed_files += collect(pending)
 
     logging.info(f"Total files: {total_files}")
     logging.info(f"Processed files: {processed_files}")
+    if cache is not None:
+        logging.info(cache.stats())
 
 def main():
     image_directory = "./output_images/"
     output_directory = "./output_text/"
     csv_path = "./unfinished_files.csv"
+    cache_path = "./ocr_cache.sqlite"
+    cache_max_bytes = 2 * 1024 * 1024 * 1024
+
+    # Concurrency and quota settings
+    max_in_flight = 8
+    requests_per_minute = 1000
+    tokens_per_minute = 4000000
+    estimated_tokens_per_page = 1500
+
+    # "inline" sends image bytes with the request, "upload" uses the File API; batch_size > 1 packs pages per request
+    transfer_mode = "inline"
+    batch_size = 1
+
+    # Set to preprocess.preprocess_config to shrink pages before sending them
+    page_preprocess_config = None
+
+    # Per-request latencies and token counts are appended to the trace; set a port to expose them to Prometheus
+    metrics_trace_file = "./metrics/geminiocr.jsonl"
+    metrics_summary_file = "./metrics/geminiocr_summary.json"
+    prometheus_port = None
 
     unfinished_files = load_unfinished_files(csv_path)
 
     if not os.path.exists(output_directory):
         os.makedirs(output_directory)
 
-    process_images(image_directory, output_directory, unfinished_files, csv_path)
+    metrics.configure(metrics_trace_file, prometheus_port)
+
+    stop_cleanup = None
+    if transfer_mode == "upload" and orphan_cleanup["enabled"]:
+        stop_cleanup = start_background_cleanup(timedelta(hours=orphan_cleanup["min_age_hours"]), upload_display_prefix,
+                                                timedelta(minutes=orphan_cleanup["interval_minutes"]),
+                                                orphan_cleanup["workers"], output=logging.info)
+
+    limiter = RateLimiter(requests_per_minute, tokens_per_minute)
+    cache = OCRCache(cache_path, max_bytes=cache_max_bytes)
+    process_images(image_directory, output_directory, unfinished_files, csv_path,
+                   max_in_flight=max_in_flight, limiter=limiter, estimated_tokens=estimated_tokens_per_page, cache=cache,
+                   transfer_mode=transfer_mode, batch_size=batch_size, preprocess_config=page_preprocess_config)
+    cache.close()
+    if stop_cleanup is not None:
+        stop_cleanup.set()
+    metrics.report(metrics_summary_file)
 
 if __name__ == "__main__":
     main()
@@ -1,73 +1,175 @@
-import os
-from transformers import pipeline
+import time
+from collections import Counter
+from entity_sink import Entity, open_sink
+from metrics import metrics
+from text_loader import read_text_segments
+from transformers import AutoModelForTokenClassification, AutoTokenizer, pipeline
 
-# Initialize the NER pipeline using a Hugging Face model
-ner_pipeline = pipeline("ner", model="dbmdz/bert-large-cased-finetuned-conll03-english")
+# Hugging Face model used for NER
+model_name = "dbmdz/bert-large-cased-finetuned-conll03-english"
+
+# Inference backend: "torch", "quantized" (dynamic int8 quantization of the linear layers) or "onnx" (ONNX Runtime)
+backend = "torch"
+
+# Chunking settings: tokens per window (BERT takes 512 including special tokens) and tokens shared by neighbouring windows
+max_window_tokens = 500
+window_stride = 64
+
+# Number of chunks sent through the model together
+batch_size = 16
 
 # Define the root directory containing subfolders with text files
 root_directory = "./output_text"
 
-# Define output file
-output_file = "./output_entities/entities_by_type_huggingface.txt"
+# Define output file; the format ("text", "jsonl" or "parquet") follows the extension
+output_file = "./output_entities/entities_by_type_huggingface.jsonl"
 
-# Function to process a single text file and extract entities with metadata
-def process_file(file_path):
-    try:
-        with open(file_path, 'r', encoding='utf-8') as file:
-            text = file.read()
-        # Run NER using the Hugging Face model
-        ner_results = ner_pipeline(text)
+# Function to initialize the NER pipeline on the CPU with the chosen backend
+def load_pipeline(model_name, backend="torch"):
+    tokenizer = AutoTokenizer.from_pretrained(model_name)
+
+    if backend == "onnx":
+        from optimum.onnxruntime import ORTModelForTokenClassification
+        model = ORTModelForTokenClassification.from_pretrained(model_name, export=True)
+    else:
+        model = AutoModelForTokenClassification.from_pretrained(model_name)
+        if backend == "quantized":
+            import torch
+            model = torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+
+    print(f"Loaded {model_name} with the {backend} backend")
+    return pipeline("ner", model=model, tokenizer=tokenizer)
+
+# Function to split text into overlapping token windows
+def split_into_windows(text, tokenizer, max_tokens=500, stride=64):
+    """Return (window start, window end, owned start, owned end) character offsets for each window.
 
-        entities_with_metadata = []
+    Neighbouring windows share stride tokens. Each window owns the characters up to the middle of its
+    overlaps, so an entity found in both windows is only kept once.
+    """
+    offsets = tokenizer(text, add_special_tokens=False, return_offsets_mapping=True)["offset_mapping"]
+    if not offsets:
+        return []
+
+    step = max_tokens - stride
+    starts = list(range(0, max(1, len(offsets) - stride), step))
+    windows = []
+    for index, start in enumerate(starts):
+        end = min(start + max_tokens, len(offsets))
+        owned_start = 0 if index == 0 else offsets[start + stride // 2][0]
+        owned_end = len(text) if index == len(starts) - 1 else offsets[starts[index + 1] + stride // 2][0]
+        windows.append((offsets[start][0], offsets[end - 1][1], owned_start, owned_end))
+    return windows
+
+# Function to split (text, file path, offset) segments into chunks lazily, with positions relative to the whole file
+def split_texts_into_chunks(segments, tokenizer, max_tokens, stride):
+    for text, file_path, offset in segments:
+        try:
+            windows = split_into_windows(text, tokenizer, max_tokens, stride)
+        except Exception as e:
+            print(f"Error processing file {file_path}: {e}")
+            continue
+        for window_start, window_end, owned_start, owned_end in windows:
+            yield (text[window_start:window_end], file_path, offset + window_start,
+                   offset + owned_start, offset + owned_end)
+
+# Function to run NER on chunks and map the entities back to whole-file positions
+def run_chunks(ner_pipeline, chunks, batch_size):
+    texts = [chunk[0] for chunk in chunks]
+    entities = []
+    for (_, file_path, offset, owned_start, owned_end), ner_results in zip(chunks, ner_pipeline(texts, batch_size=batch_size)):
         for entity in ner_results:
+            start_char = entity['start'] + offset
+            if not owned_start <= start_char < owned_end:
+                continue  # Found again in the overlap of the neighbouring window
+
             # Capture entity text, label, and context (file path and position)
-            entity_data = {
-                "entity": entity['word'],
-                "label": entity['entity'],
-                "file_path": file_path,
-                "start_char": entity['start'],
-                "end_char": entity['end']
-            }
-            entities_with_metadata.append(entity_data)
-        
-        return entities_with_metadata
-    except Exception as e:
-        print(f"Error processing file {file_path}: {e}")
-        return []
+            entities.append(Entity(entity['word'], entity['entity'], file_path, start_char, entity['end'] + offset))
+    return entities
 
-# Function to process all text files in a directory (including subdirectories)
-def process_directory(directory_path):
-    all_entities = []
-
-    for subdir, _, files in os.walk(directory_path):
-        for file in files:
-            if file.endswith('.txt'):
-                file_path = os.path.join(subdir, file)
-                entities = process_file(file_path)
-                
-                # Add entities from the current file to the overall collection
-                all_entities.extend(entities)
-    
-    return all_entities
-
-# Function to handle file output
-def write_to_output_file(output_file, entities_with_metadata):
+# Function to run NER on a group of chunks. If the group fails, its files are run one at a time so a
+# bad file is logged and skipped without losing the rest of the group.
+def process_chunks(ner_pipeline, chunks, batch_size):
+    start_time = time.perf_counter()
     try:
-        # Ensure the directory exists
-        os.makedirs(os.path.dirname(output_file), exist_ok=True)
-        
-        # Write the entities with metadata to the output file
-        with open(output_file, 'w', encoding='utf-8') as f:
-            for entity_data in entities_with_metadata:
-                f.write(f"Entity: {entity_data['entity']}, Label: {entity_data['label']}, "
-                        f"File: {entity_data['file_path']}, "
-                        f"Position: ({entity_data['start_char']}, {entity_data['end_char']})\n")
-        print(f"Entities successfully written to {output_file}")
+        entities = run_chunks(ner_pipeline, chunks, batch_size)
     except Exception as e:
-        print(f"Error writing to file {output_file}: {e}")
+        print(f"Error processing a batch of {len(chunks)} chunks, retrying file by file: {e}")
+        chunks_by_file = {}
+        for chunk in chunks:
+            chunks_by_file.setdefault(chunk[1], []).append(chunk)
+        entities = []
+        for file_path, file_chunks in chunks_by_file.items():
+            try:
+                entities.extend(run_chunks(ner_pipeline, file_chunks, batch_size))
+            except Exception as e:
+                print(f"Error processing file {file_path}: {e}")
+
+    # The group runs as one batch, so each file is charged for its share of the chunks
+    elapsed = time.perf_counter() - start_time
+    chunks_per_file = Counter(chunk[1] for chunk in chunks)
+    for file_path, file_chunks in chunks_per_file.items():
+        metrics.record("ner", elapsed * file_chunks / len(chunks), file_path, engine="huggingface", chunks=file_chunks)
+
+    return entities
+
+# Function to process (text, file path, offset) segments, writing the entities of each group of chunks to
+# the sink as soon as it is done. Returns the number of files, chunks and entities.
+def process_texts(ner_pipeline, segments, sink, batch_size=16, max_tokens=500, stride=64):
+    file_count = 0
+    last_file_path = None
+    chunk_count = 0
+    entity_count = 0
 
-# Run the processing on the root directory
-entities_with_metadata = process_directory(root_directory)
+    # Chunks from several files are grouped so batches stay full across file boundaries
+    group = []
+    for chunk in split_texts_into_chunks(segments, ner_pipeline.tokenizer, max_tokens, stride):
+        group.append(chunk)
+        if chunk[1] != last_file_path:
+            file_count += 1
+            last_file_path = chunk[1]
+        if len(group) == batch_size * 8:
+            entities = process_chunks(ner_pipeline, group, batch_size)
+            sink.write(entities)
+            entity_count += len(entities)
+            chunk_count += len(group)
+            group = []
+    if group:
+        entities = process_chunks(ner_pipeline, group, batch_size)
+        sink.write(entities)
+        entity_count += len(entities)
+        chunk_count += len(group)
+
+    return file_count, chunk_count, entity_count
+
+# Function to process all text files in a directory (including subdirectories)
+def process_directory(ner_pipeline, directory_path, sink, batch_size=16, max_tokens=500, stride=64):
+    start_time = time.perf_counter()
 
-# Write the results to the output file
-write_to_output_file(output_file, entities_with_metadata)
\ No newline at end of file
+    file_count, chunk_count, entity_count = process_texts(ner_pipeline, read_text_segments(directory_path), sink,
+                                                          batch_size, max_tokens, stride)
+
+    elapsed = time.perf_counter() - start_time
+    pages_per_second = file_count / elapsed if elapsed > 0 else 0.0
+    print(f"Processed {file_count} pages ({chunk_count} chunks) in {elapsed:.1f}s ({pages_per_second:.2f} pages/sec), {entity_count} entities")
+
+    return entity_count
+
+# Per-page NER latencies are appended to the trace and summarized at the end
+metrics_trace_file = "./metrics/huggingface_entityextraction.jsonl"
+metrics_summary_file = "./metrics/huggingface_entityextraction_summary.json"
+
+if __name__ == "__main__":
+    metrics.configure(metrics_trace_file)
+    # Initialize the NER pipeline using a Hugging Face model
+    ner_pipeline = load_pipeline(model_name, backend)
+
+    # Run the processing on the root directory, streaming the results to the output file
+    sink = open_sink(output_file)
+    try:
+        process_directory(ner_pipeline, root_directory, sink, batch_size=batch_size,
+                          max_tokens=max_window_tokens, stride=window_stride)
+    finally:
+        sink.close()
+    print(f"Entities successfully written to {output_file}")
+    metrics.report(metrics_summary_file, output=print)
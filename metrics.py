@@ -0,0 +1,146 @@
+import os
+import json
+import math
+import time
+import logging
+import threading
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+def percentile(sorted_values, fraction):
+    """Return the value at the given fraction (0-1) of a sorted list, using the nearest rank."""
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, math.ceil(fraction * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+class Metrics:
+    """Collects per-stage latencies and counters, writes them as a JSONL trace and summarizes them.
+
+    Stages are named after what they time (render, upload, generate, delete, correct, ner_spacy, ...).
+    Counters hold everything else: retries, throttles, input and output tokens.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.timings = {}
+        self.counters = {}
+        self.trace = None
+        self.server = None
+
+    def configure(self, trace_file=None, prometheus_port=None):
+        """Start writing the JSONL trace to trace_file and, optionally, serve metrics for Prometheus on a local port."""
+        if trace_file:
+            directory = os.path.dirname(trace_file)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self.trace = open(trace_file, "a", encoding="utf-8")
+        if prometheus_port:
+            self.serve_prometheus(prometheus_port)
+
+    def reset(self):
+        """Drop the samples and counters collected so far."""
+        with self.lock:
+            self.timings = {}
+            self.counters = {}
+
+    def record(self, stage, seconds, item=None, **fields):
+        """Record one latency sample for the stage."""
+        with self.lock:
+            self.timings.setdefault(stage, []).append(seconds)
+            if self.trace is not None:
+                event = {"ts": time.time(), "stage": stage, "seconds": round(seconds, 6)}
+                if item is not None:
+                    event["item"] = item
+                event.update(fields)
+                self.trace.write(json.dumps(event) + "\n")
+
+    def count(self, name, amount=1):
+        """Add to a counter."""
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    @contextmanager
+    def timer(self, stage, item=None, **fields):
+        """Time the body of a with block as one sample of the stage."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(stage, time.perf_counter() - start, item, **fields)
+
+    def summary(self):
+        """Return count, total and p50/p95/p99/max latency per stage, and the counters."""
+        with self.lock:
+            timings = {stage: sorted(values) for stage, values in self.timings.items()}
+            counters = dict(self.counters)
+        stages = {}
+        for stage, values in timings.items():
+            stages[stage] = {
+                "count": len(values),
+                "total_seconds": sum(values),
+                "p50": percentile(values, 0.50),
+                "p95": percentile(values, 0.95),
+                "p99": percentile(values, 0.99),
+                "max": values[-1],
+            }
+        return {"stages": stages, "counters": counters}
+
+    def report(self, summary_file=None, output=logging.info):
+        """Print the summary through output, write it to summary_file if given, and flush the trace."""
+        summary = self.summary()
+        for stage, stats in sorted(summary["stages"].items()):
+            output(f"{stage}: {stats['count']} samples, {stats['total_seconds']:.1f}s total, "
+                   f"p50 {stats['p50'] * 1000:.0f} ms, p95 {stats['p95'] * 1000:.0f} ms, "
+                   f"p99 {stats['p99'] * 1000:.0f} ms, max {stats['max'] * 1000:.0f} ms")
+        for name, value in sorted(summary["counters"].items()):
+            output(f"{name}: {value}")
+
+        if summary_file:
+            with open(summary_file, "w", encoding="utf-8") as f:
+                json.dump(summary, f, indent=2)
+        if self.trace is not None:
+            self.trace.flush()
+        return summary
+
+    def prometheus_text(self):
+        """Render the summary in the Prometheus text exposition format."""
+        summary = self.summary()
+        lines = [
+            "# TYPE carl_stage_seconds summary",
+        ]
+        for stage, stats in sorted(summary["stages"].items()):
+            for quantile, key in (("0.5", "p50"), ("0.95", "p95"), ("0.99", "p99")):
+                lines.append(f'carl_stage_seconds{{stage="{stage}",quantile="{quantile}"}} {stats[key]}')
+            lines.append(f'carl_stage_seconds_sum{{stage="{stage}"}} {stats["total_seconds"]}')
+            lines.append(f'carl_stage_seconds_count{{stage="{stage}"}} {stats["count"]}')
+        lines.append("# TYPE carl_counter_total counter")
+        for name, value in sorted(summary["counters"].items()):
+            lines.append(f'carl_counter_total{{name="{name}"}} {value}')
+        return "\n".join(lines) + "\n"
+
+    def serve_prometheus(self, port):
+        """Serve /metrics on localhost from a background thread."""
+        registry = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path != "/metrics":
+                    self.send_error(404)
+                    return
+                body = registry.prometheus_text().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("localhost", port), Handler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        logging.info(f"Serving metrics on http://localhost:{port}/metrics")
+
+# Shared by every stage in the process
+metrics = Metrics()
@@ -0,0 +1,200 @@
+import os
+import sys
+import time
+import hashlib
+import secrets
+import argparse
+import traceback
+from datetime import datetime
+from multiprocessing.connection import Listener, Client
+from entity_sink import open_sink
+from text_loader import read_text_segments
+
+# Local address of the worker
+default_address = ("localhost", 6011)
+
+# Jobs are pickled over the connection, so only clients holding the key may connect. The key comes from
+# NER_WORKER_AUTHKEY or, failing that, from a file only the owner can read, which serve creates.
+authkey_file = os.path.expanduser("~/.carl_ner_worker_key")
+
+# Jobs without explicit outputs write a new file per job and engine under this directory
+job_output_directory = "./output_entities/"
+
+# Segments read per step (one per page file, more for very large files); each step is fed to every
+# requested engine before the next segments are read
+segments_per_step = 256
+
+def batched(iterable, size):
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def load_authkey(create=False):
+    """Return the key from NER_WORKER_AUTHKEY or authkey_file, creating the file if create is set."""
+    key = os.environ.get("NER_WORKER_AUTHKEY")
+    if key:
+        return key.encode("utf-8")
+
+    if create and not os.path.exists(authkey_file):
+        # O_EXCL with mode 0600 means the key is never readable by anyone else, not even briefly
+        fd = os.open(authkey_file, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        with os.fdopen(fd, "w") as f:
+            f.write(secrets.token_hex(32))
+        print(f"Created worker key in {authkey_file}")
+
+    if not os.path.exists(authkey_file):
+        raise RuntimeError(f"No worker key: set NER_WORKER_AUTHKEY or start the worker to create {authkey_file}")
+    if os.stat(authkey_file).st_mode & 0o077:
+        raise RuntimeError(f"{authkey_file} is readable by other users; restrict it with chmod 600")
+    with open(authkey_file) as f:
+        key = f.read().strip()
+    if not key:
+        raise RuntimeError(f"{authkey_file} is empty")
+    return key.encode("utf-8")
+
+def job_outputs(job, engines):
+    """Return the output file of each engine: the job's own outputs, or new files named after the job."""
+    outputs = dict(job.get("outputs") or {})
+    paths_hash = hashlib.sha256("\n".join(sorted(job["paths"])).encode("utf-8")).hexdigest()[:12]
+    job_name = f"job_{datetime.now():%Y%m%d_%H%M%S}_{paths_hash}.jsonl"
+    for engine in engines:
+        outputs.setdefault(engine, os.path.join(job_output_directory, engine, "jobs", job_name))
+    return outputs
+
+class NERWorker:
+    """Holds the NER models in memory and runs extraction jobs against them."""
+
+    def __init__(self, engines):
+        self.models = {}
+        if "spacy" in engines:
+            import spacy_entityextraction
+            self.spacy = spacy_entityextraction
+            self.models["spacy"] = spacy_entityextraction.load_model()
+        if "hf" in engines:
+            import huggingface_entityextraction
+            self.hf = huggingface_entityextraction
+            self.models["hf"] = huggingface_entityextraction.load_pipeline(
+                huggingface_entityextraction.model_name, huggingface_entityextraction.backend)
+
+    def run_job(self, job):
+        """Run a job: {"paths": [directories or files], "engines": [...], "outputs": {engine: file}}.
+
+        Outputs are opened for writing, so a job never shares an output with another job unless asked to.
+        """
+        if not isinstance(job, dict) or not isinstance(job.get("paths"), list):
+            raise ValueError("A job must be a dict with a list of paths")
+        engines = job.get("engines") or list(self.models)
+        missing = [engine for engine in engines if engine not in self.models]
+        if missing:
+            raise ValueError(f"Engine(s) not loaded in this worker: {', '.join(missing)}")
+
+        outputs = job_outputs(job, engines)
+        sinks = {engine: open_sink(outputs[engine]) for engine in engines}
+        entity_counts = {engine: 0 for engine in engines}
+        file_count = 0
+        last_file_path = None
+        start_time = time.perf_counter()
+
+        try:
+            # Each file is read once and passed to every engine, a segment at a time for very large files
+            for segments in batched(read_text_segments(job["paths"]), segments_per_step):
+                for _, file_path, _ in segments:
+                    if file_path != last_file_path:
+                        file_count += 1
+                        last_file_path = file_path
+                if "spacy" in engines:
+                    _, entities = self.spacy.process_texts(self.models["spacy"], segments, sinks["spacy"],
+                                                           batch_size=self.spacy.batch_size)
+                    entity_counts["spacy"] += entities
+                if "hf" in engines:
+                    _, _, entities = self.hf.process_texts(self.models["hf"], segments, sinks["hf"],
+                                                           batch_size=self.hf.batch_size,
+                                                           max_tokens=self.hf.max_window_tokens,
+                                                           stride=self.hf.window_stride)
+                    entity_counts["hf"] += entities
+        finally:
+            for sink in sinks.values():
+                sink.close()
+
+        elapsed = time.perf_counter() - start_time
+        return {"status": "ok", "files": file_count, "entities": entity_counts, "outputs": outputs, "seconds": elapsed}
+
+def serve(engines, address=default_address, authkey=None):
+    """Load the models once and run jobs from local clients, one at a time, until told to shut down."""
+    authkey = authkey or load_authkey(create=True)
+    worker = NERWorker(engines)
+    with Listener(address, authkey=authkey) as listener:
+        print(f"NER worker with {', '.join(worker.models)} listening on {address[0]}:{address[1]}")
+        while True:
+            # A client with the wrong key, one that disconnects or one that sends garbage must not stop the worker
+            try:
+                with listener.accept() as connection:
+                    job = connection.recv()
+                    if isinstance(job, dict) and job.get("command") == "shutdown":
+                        connection.send({"status": "ok"})
+                        print("Shutting down")
+                        return
+
+                    print(f"Job received: {job}")
+                    try:
+                        result = worker.run_job(job)
+                    except Exception as e:
+                        traceback.print_exc()
+                        result = {"status": "error", "error": str(e)}
+                    print(f"Job finished: {result}")
+                    connection.send(result)
+            except Exception as e:
+                print(f"Connection failed: {type(e).__name__}: {e}")
+
+def submit_job(job, address=default_address, authkey=None):
+    """Send a job to a running worker and wait for its result."""
+    with Client(address, authkey=authkey or load_authkey()) as connection:
+        connection.send(job)
+        return connection.recv()
+
+def main():
+    parser = argparse.ArgumentParser(description="Long-lived NER worker that keeps the spaCy and Hugging Face models loaded.")
+    parser.add_argument("--host", default=default_address[0])
+    parser.add_argument("--port", type=int, default=default_address[1])
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    serve_parser = subparsers.add_parser("serve", help="Load the models and wait for jobs")
+    serve_parser.add_argument("--engines", nargs="+", choices=["spacy", "hf"], default=["spacy"])
+
+    submit_parser = subparsers.add_parser("submit", help="Send a job to a running worker")
+    submit_parser.add_argument("paths", nargs="+", help="Directories or text files to process")
+    submit_parser.add_argument("--engines", nargs="+", choices=["spacy", "hf"], default=None,
+                               help="Engines to run (default: every engine the worker loaded)")
+    submit_parser.add_argument("--spacy-output", default=None)
+    submit_parser.add_argument("--hf-output", default=None)
+
+    subparsers.add_parser("shutdown", help="Stop a running worker")
+
+    args = parser.parse_args()
+    address = (args.host, args.port)
+
+    if args.command == "serve":
+        serve(args.engines, address)
+        return
+
+    if args.command == "shutdown":
+        print(submit_job({"command": "shutdown"}, address))
+        return
+
+    outputs = {}
+    if args.spacy_output:
+        outputs["spacy"] = args.spacy_output
+    if args.hf_output:
+        outputs["hf"] = args.hf_output
+    result = submit_job({"paths": args.paths, "engines": args.engines, "outputs": outputs}, address)
+    print(result)
+    if result.get("status") != "ok":
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+import json
+import hashlib
+import sqlite3
+import threading
+import time
+
+def make_cache_key(image_bytes, model_name, prompt, generation_config):
+    """Hash the image bytes together with everything else that determines the model output."""
+    digest = hashlib.sha256()
+    digest.update(image_bytes)
+    digest.update(b"\0")
+    digest.update(model_name.encode("utf-8"))
+    digest.update(b"\0")
+    digest.update(prompt.encode("utf-8"))
+    digest.update(b"\0")
+    digest.update(json.dumps(generation_config, sort_keys=True).encode("utf-8"))
+    return digest.hexdigest()
+
+class OCRCache:
+    """Content-addressed store of OCR results in SQLite, evicting least recently used entries beyond max_bytes."""
+
+    def __init__(self, path, max_bytes=1024 * 1024 * 1024):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            """CREATE TABLE IF NOT EXISTS entries (
+                key TEXT PRIMARY KEY,
+                text TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                last_access REAL NOT NULL
+            )"""
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS entries_last_access ON entries (last_access)")
+        self.conn.commit()
+        self.total_bytes = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+
+    def get(self, key):
+        """Return the cached text for the key, or None."""
+        with self.lock:
+            row = self.conn.execute("SELECT text FROM entries WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            with self.conn:
+                self.conn.execute("UPDATE entries SET last_access = ? WHERE key = ?", (time.time(), key))
+            return row[0]
+
+    def put(self, key, text):
+        """Store the text for the key and evict old entries if the cache grew past its size limit."""
+        size = len(text.encode("utf-8"))
+        with self.lock:
+            with self.conn:
+                row = self.conn.execute("SELECT size FROM entries WHERE key = ?", (key,)).fetchone()
+                if row is not None:
+                    self.total_bytes -= row[0]
+                self.conn.execute(
+                    "INSERT OR REPLACE INTO entries (key, text, size, last_access) VALUES (?, ?, ?, ?)",
+                    (key, text, size, time.time()),
+                )
+                self.total_bytes += size
+                if self.total_bytes > self.max_bytes:
+                    self._evict()
+
+    def _evict(self):
+        # Drop the least recently used entries until the cache is back under 90% of its limit
+        target = self.max_bytes * 0.9
+        rows = self.conn.execute("SELECT key, size FROM entries ORDER BY last_access")
+        evicted = []
+        for key, size in rows:
+            if self.total_bytes <= target:
+                break
+            evicted.append((key,))
+            self.total_bytes -= size
+        self.conn.executemany("DELETE FROM entries WHERE key = ?", evicted)
+
+    def stats(self):
+        """Return a summary of cache hits and misses for this run."""
+        lookups = self.hits + self.misses
+        hit_rate = (self.hits / lookups * 100) if lookups else 0.0
+        return f"OCR cache: {self.hits} hit(s), {self.misses} miss(es), {hit_rate:.1f}% hit rate, {self.total_bytes} bytes stored"
+
+    def close(self):
+        self.conn.close()
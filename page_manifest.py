@@ -0,0 +1,65 @@
+import os
+import json
+import sqlite3
+from datetime import datetime
+
+class PageManifest:
+    """Indexed record of the status of every (pdf path, page) pair, stored in SQLite.
+
+    The database runs in WAL mode, so several processes can open the same manifest
+    and record pages concurrently while readers never block on writers.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.is_new = not os.path.exists(path)
+        self.conn = sqlite3.connect(path, timeout=30)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            """CREATE TABLE IF NOT EXISTS pages (
+                pdf_path TEXT NOT NULL,
+                page INTEGER NOT NULL,
+                status TEXT NOT NULL,
+                image_path TEXT,
+                updated_at TEXT NOT NULL,
+                PRIMARY KEY (pdf_path, page)
+            )"""
+        )
+        self.conn.commit()
+
+    def record_pages(self, pdf_path, pages, status, output_paths=None):
+        """Record the status of a batch of pages in a single transaction."""
+        now = datetime.now().isoformat()
+        if output_paths is None:
+            output_paths = [None] * len(pages)
+        with self.conn:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO pages (pdf_path, page, status, image_path, updated_at) VALUES (?, ?, ?, ?, ?)",
+                [(pdf_path, page, status, path, now) for page, path in zip(pages, output_paths)],
+            )
+
+    def record_page(self, pdf_path, page, status, image_path=None):
+        """Record the status of a single page."""
+        self.record_pages(pdf_path, [page], status, [image_path])
+
+    def done_pages(self, pdf_path):
+        """Return the set of pages of the PDF that are recorded as done."""
+        rows = self.conn.execute(
+            "SELECT page FROM pages WHERE pdf_path = ? AND status = 'done'", (pdf_path,)
+        )
+        return {row[0] for row in rows}
+
+    def import_checkpoint(self, checkpoint_file):
+        """Import the page counts of a legacy checkpoint JSON file as done pages."""
+        if not os.path.exists(checkpoint_file):
+            return 0
+        with open(checkpoint_file, "r") as f:
+            checkpoint = json.load(f)
+        for pdf_path, last_page in checkpoint.items():
+            self.record_pages(pdf_path, list(range(1, last_page + 1)), "done")
+        print(f"Imported {len(checkpoint)} PDFs from legacy checkpoint {checkpoint_file}")
+        return len(checkpoint)
+
+    def close(self):
+        self.conn.close()
@@ -1,7 +1,10 @@
 import os
+import time
 import subprocess
-import json
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from pdf2image import convert_from_path
+from page_manifest import PageManifest
+from metrics import metrics
 
 def find_pdfs(directory):
     """Recursively find all PDF files in the directory and subdirectories."""
@@ -12,35 +15,29 @@ def find_pdfs(directory):
                 pdf_files.append(os.path.join(root, file))
     return sorted(pdf_files)  # Sort files for consistent processing order
 
-def load_checkpoint():
-    """Load the last processed files and pages from the checkpoint file."""
-    if os.path.exists(checkpoint_file):
-        with open(checkpoint_file, "r") as f:
-            checkpoint = json.load(f)
-        print(f"Loaded checkpoint: {checkpoint}")
-        return checkpoint
-    return {}
-
-def save_checkpoint(checkpoint):
-    """Save the current files and their last processed pages to the checkpoint file."""
-    with open(checkpoint_file, "w") as f:
-        json.dump(checkpoint, f)
-    print(f"Checkpoint saved: {checkpoint}")
-
-def get_existing_images(output_directory):
-    """Get a list of existing image files in the output directory."""
-    existing_images = set()
-    for root, dirs, files in os.walk(output_directory):
-        for file in files:
-            if file.endswith('.png'):
-                existing_images.add(file)
-    return existing_images
+def open_manifest():
+    """Open the page manifest, importing the legacy checkpoint file the first time it is created."""
+    manifest = PageManifest(manifest_file)
+    if manifest.is_new:
+        manifest.import_checkpoint(checkpoint_file)
+    return manifest
+
+def get_page_count(pdf_path):
+    """Get the total number of pages using pdfinfo (comes with poppler-utils)."""
+    result = subprocess.run(["pdfinfo", pdf_path], stdout=subprocess.PIPE, text=True)
+    for line in result.stdout.splitlines():
+        if "Pages:" in line:
+            return int(line.split(":")[1].strip())
+    raise ValueError(f"Could not determine the page count of {pdf_path}")
+
+def get_image_path(pdf_path, output_directory, page_number):
+    """Return the output path of the PNG for a 1-based page number of the PDF."""
+    subfolder_name = os.path.basename(os.path.dirname(pdf_path))
+    image_filename = f"{os.path.basename(pdf_path)[:-4]}_page_{page_number}.png"
+    return os.path.join(output_directory, subfolder_name, image_filename)
 
-def save_images_from_pdf(pdf_path, output_directory, checkpoint, start_page=0, existing_images=None):
+def save_images_from_pdf(pdf_path, output_directory, manifest):
     """Convert each page of the PDF to a PNG image and save to disk, one page at a time to optimize memory usage."""
-    if existing_images is None:
-        existing_images = set()
-
     # Determine the subfolder name based on the PDF's parent folder
     subfolder_name = os.path.basename(os.path.dirname(pdf_path))
     subfolder_path = os.path.join(output_directory, subfolder_name)
@@ -51,30 +48,24 @@ def save_images_from_pdf(pdf_path, output_directory, checkpoint, start_page=0, e
 
     print(f"Processing: {pdf_path}")
     try:
-        # Get the total number of pages using pdfinfo (comes with poppler-utils)
-        result = subprocess.run(["pdfinfo", pdf_path], stdout=subprocess.PIPE, text=True)
-        for line in result.stdout.splitlines():
-            if "Pages:" in line:
-                total_pages = int(line.split(":")[1].strip())
-                break
-        
+        total_pages = get_page_count(pdf_path)
         print(f"Total pages in {pdf_path}: {total_pages}")
 
-        for page_number in range(start_page, total_pages):
-            image_filename = f"{os.path.basename(pdf_path)[:-4]}_page_{page_number+1}.png"
-            image_path = os.path.join(subfolder_path, image_filename)
+        done_pages = manifest.done_pages(pdf_path)
 
-            if image_filename in existing_images:
-                print(f"Skipping {image_filename} (already exists)")
+        for page_number in range(1, total_pages + 1):
+            if page_number in done_pages:
                 continue
 
-            images = convert_from_path(pdf_path, first_page=page_number+1, last_page=page_number+1)
-            images[0].save(image_path, 'PNG')
+            image_path = get_image_path(pdf_path, output_directory, page_number)
+
+            with metrics.timer("render", image_path):
+                images = convert_from_path(pdf_path, first_page=page_number, last_page=page_number)
+                images[0].save(image_path, 'PNG')
             print(f"Saved {image_path}")
 
-            # Save checkpoint after processing each page
-            checkpoint[pdf_path] = page_number + 1
-            save_checkpoint(checkpoint)
+            # Record the page in the manifest after processing it
+            manifest.record_page(pdf_path, page_number, "done", image_path)
 
             # Clean up to free memory
             del images
@@ -86,20 +77,119 @@ def process_pdfs(directory, output_directory):
     """Process all PDFs in the given directory, convert them to images, and save to disk."""
     pdf_files = find_pdfs(directory)
 
-    checkpoint = load_checkpoint()
+    manifest = open_manifest()
 
     print(f"Found {len(pdf_files)} PDF files in directory '{directory}'")
 
-    # Get the existing images in the output directory
-    existing_images = get_existing_images(output_directory)
-
     for pdf_file in pdf_files:
-        last_page = checkpoint.get(pdf_file, 0)
-        save_images_from_pdf(pdf_file, output_directory, checkpoint, start_page=last_page, existing_images=existing_images)
+        save_images_from_pdf(pdf_file, output_directory, manifest)
+
+    manifest.close()
+
+def find_missing_ranges(done_pages, total_pages, chunk_size):
+    """Group the pages that are not done yet into contiguous ranges of at most chunk_size pages."""
+    ranges = []
+    first_page = None
+    for page_number in range(1, total_pages + 1):
+        if page_number in done_pages:
+            if first_page is not None:
+                ranges.append((first_page, page_number - 1))
+                first_page = None
+            continue
+
+        if first_page is None:
+            first_page = page_number
+        if page_number - first_page + 1 == chunk_size:
+            ranges.append((first_page, page_number))
+            first_page = None
+
+    if first_page is not None:
+        ranges.append((first_page, total_pages))
+    return ranges
+
+def render_page_range(pdf_path, output_directory, first_page, last_page):
+    """Render a contiguous page range with a single poppler call and save every page as a PNG.
+
+    Returns the number of pages saved and the seconds it took.
+    """
+    start = time.perf_counter()
+    images = convert_from_path(pdf_path, first_page=first_page, last_page=last_page)
+    for offset, image in enumerate(images):
+        image_path = get_image_path(pdf_path, output_directory, first_page + offset)
+
+        # Save under a temporary name first so an interrupted write is never mistaken for a finished page
+        temp_path = f"{image_path}.tmp"
+        image.save(temp_path, 'PNG')
+        os.replace(temp_path, image_path)
+        image.close()
+
+    return len(images), time.perf_counter() - start
+
+def process_pdfs_parallel(directory, output_directory, workers=None, chunk_size=10):
+    """Process all PDFs with a pool of worker processes, spreading page ranges of every PDF across the workers."""
+    pdf_files = find_pdfs(directory)
+
+    manifest = open_manifest()
+
+    print(f"Found {len(pdf_files)} PDF files in directory '{directory}'")
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {}
+        total_pages = {}
+
+        for pdf_file in pdf_files:
+            try:
+                total_pages[pdf_file] = get_page_count(pdf_file)
+            except Exception as e:
+                print(f"Error processing {pdf_file}: {e}")
+                continue
+
+            os.makedirs(os.path.dirname(get_image_path(pdf_file, output_directory, 1)), exist_ok=True)
+
+            # Pages recorded as done are skipped, so an interrupted run resumes where it stopped
+            ranges = find_missing_ranges(manifest.done_pages(pdf_file), total_pages[pdf_file], chunk_size)
+            print(f"Total pages in {pdf_file}: {total_pages[pdf_file]}, {len(ranges)} range(s) to render")
+
+            for first_page, last_page in ranges:
+                future = executor.submit(render_page_range, pdf_file, output_directory, first_page, last_page)
+                futures[future] = (pdf_file, first_page, last_page)
+
+        for future in as_completed(futures):
+            pdf_file, first_page, last_page = futures[future]
+            pages = list(range(first_page, last_page + 1))
+            try:
+                _, elapsed = future.result()
+                image_paths = [get_image_path(pdf_file, output_directory, page) for page in pages]
+                # Pages of a range share one poppler call, so each is charged an equal share of its time
+                for image_path in image_paths:
+                    metrics.record("render", elapsed / len(pages), image_path)
+                manifest.record_pages(pdf_file, pages, "done", image_paths)
+                print(f"Saved pages {first_page}-{last_page} of {pdf_file}")
+            except Exception as e:
+                print(f"Error processing pages {first_page}-{last_page} of {pdf_file}: {e}")
+                manifest.record_pages(pdf_file, pages, "failed")
+
+    manifest.close()
 
 # Directory containing PDFs
 pdf_directory = "./pdfs/"
 output_directory = "./output_images/"
-checkpoint_file = "checkpoint_pdftopng.json"
-
-process_pdfs(pdf_directory, output_directory)
+manifest_file = "manifest_pdftopng.sqlite"
+checkpoint_file = "checkpoint_pdftopng.json"  # Legacy checkpoint, imported into the manifest once
+
+# Parallel rendering settings: number of worker processes (None uses every core) and pages per poppler call
+parallel = True
+workers = None
+chunk_size = 10
+
+# Per-page render latencies are appended to the trace and summarized at the end
+metrics_trace_file = "./metrics/pdftopng.jsonl"
+metrics_summary_file = "./metrics/pdftopng_summary.json"
+
+if __name__ == "__main__":
+    metrics.configure(metrics_trace_file)
+    if parallel:
+        process_pdfs_parallel(pdf_directory, output_directory, workers=workers, chunk_size=chunk_size)
+    else:
+        process_pdfs(pdf_directory, output_directory)
+    metrics.report(metrics_summary_file, output=print)
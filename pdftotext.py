@@ -0,0 +1,252 @@
+import io
+import os
+import time
+import queue
+import logging
+import threading
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from pdf2image import convert_from_path
+import geminiocr
+from ocr_cache import OCRCache
+from page_manifest import PageManifest
+from preprocess import preprocess_image, report_savings, default_render_dpi
+from pdftopng import find_pdfs, get_page_count, get_image_path, find_missing_ranges
+from ratelimit import RateLimiter
+from metrics import metrics
+
+def get_text_path(pdf_path, text_directory, page_number):
+    """Return the text output path for a page, mirroring the layout geminiocr.py produces from output_images."""
+    subfolder_name = os.path.basename(os.path.dirname(pdf_path))
+    text_filename = f"{os.path.basename(pdf_path)[:-4]}_page_{page_number}.txt"
+    return os.path.join(text_directory, subfolder_name, text_filename)
+
+def render_page_range_to_buffers(pdf_path, first_page, last_page, preprocess_config=None, keep_pngs=False):
+    """Render a contiguous page range with a single poppler call and return the pages as in-memory images.
+
+    Each page is returned as (page number, payload bytes, MIME type, PNG bytes to keep or None), together
+    with the seconds the range took. With a preprocess_config the page is rendered at its target DPI and
+    preprocessed in this worker process; kept PNGs are always rendered at the DPI pdftopng.py uses.
+    """
+    start = time.perf_counter()
+    if preprocess_config is not None and preprocess_config.get("dpi") and not keep_pngs:
+        render_dpi = preprocess_config["dpi"]
+    else:
+        render_dpi = default_render_dpi
+    images = convert_from_path(pdf_path, dpi=render_dpi, first_page=first_page, last_page=last_page)
+
+    pages = []
+    for offset, image in enumerate(images):
+        png_bytes = None
+        if preprocess_config is None or keep_pngs:
+            buffer = io.BytesIO()
+            image.save(buffer, 'PNG')
+            png_bytes = buffer.getvalue()
+
+        if preprocess_config is None:
+            payload, mime_type = png_bytes, "image/png"
+        else:
+            payload, mime_type = preprocess_image(image, preprocess_config, source_dpi=render_dpi)
+
+        pages.append((first_page + offset, payload, mime_type, png_bytes if keep_pngs else None))
+        image.close()
+    return pages, time.perf_counter() - start
+
+def ocr_worker(page_queue, csv_path, limiter, estimated_tokens, cache, transfer_mode, counts, counts_lock, on_page_done):
+    """Take rendered pages off the queue and OCR them until the end-of-work marker arrives."""
+    while True:
+        item = page_queue.get()
+        if item is None:
+            break
+
+        pdf_file, image_path, text_path, image_bytes, mime_type = item
+        try:
+            with metrics.timer("ocr", image_path):
+                saved = geminiocr.ocr_image(image_path, text_path, csv_path, limiter, estimated_tokens, cache,
+                                            transfer_mode, image_bytes=image_bytes, mime_type=mime_type)
+        except Exception as e:
+            logging.error(f"OCR worker failed on {image_path}: {e}")
+            saved = False
+
+        with counts_lock:
+            counts["processed" if saved else "failed"] += 1
+        on_page_done(pdf_file)
+
+def process_pdfs_to_text(pdf_directory, image_directory, text_directory, csv_path, render_workers=None, chunk_size=10,
+                         ocr_workers=8, queue_depth=32, keep_pngs=False, limiter=None, estimated_tokens=0, cache=None,
+                         transfer_mode="inline", manifest=None, preprocess_config=None, pdf_files=None, on_pdf_done=None):
+    """Render PDFs and OCR their pages in one streaming pass, writing only the text output.
+
+    Rendered pages travel as in-memory PNGs through a queue of at most queue_depth pages, and at most
+    render_workers chunks are rendered ahead of the OCR workers, so memory stays bounded no matter how
+    large the corpus is. With keep_pngs the PNGs are also saved to image_directory as pdftopng.py would.
+    With a preprocess_config pages are rendered at its DPI and shrunk before OCR.
+
+    pdf_files restricts the run to the given PDFs. on_pdf_done is called with a PDF's path as soon as
+    every page of it has gone through OCR, so later stages can start on it while other PDFs render.
+    """
+    if pdf_files is None:
+        pdf_files = find_pdfs(pdf_directory)
+        logging.info(f"Found {len(pdf_files)} PDF files in directory '{pdf_directory}'")
+    unfinished_files = geminiocr.load_unfinished_files(csv_path)
+
+    # Pages of each PDF still to go through OCR
+    pending_pages = {}
+    pending_lock = threading.Lock()
+
+    def pages_done(pdf_file, count=1):
+        with pending_lock:
+            pending_pages[pdf_file] -= count
+            finished = pending_pages[pdf_file] == 0
+        if finished and on_pdf_done is not None:
+            on_pdf_done(pdf_file)
+
+    page_queue = queue.Queue(maxsize=queue_depth)
+    counts = {"processed": 0, "failed": 0}
+    counts_lock = threading.Lock()
+    workers = [
+        threading.Thread(target=ocr_worker, args=(page_queue, csv_path, limiter, estimated_tokens, cache,
+                                                  transfer_mode, counts, counts_lock, pages_done))
+        for _ in range(ocr_workers)
+    ]
+    for worker in workers:
+        worker.start()
+
+    # Render futures in flight, mapped to the PDF and page range they cover
+    futures_info = {}
+    max_pending = render_workers or os.cpu_count()
+
+    def enqueue_pages(pdf_file, pages):
+        for page_number, image_bytes, mime_type, png_bytes in pages:
+            image_path = get_image_path(pdf_file, image_directory, page_number)
+            if png_bytes is not None:
+                # Save under a temporary name first so an interrupted write is never mistaken for a finished page
+                temp_path = f"{image_path}.tmp"
+                with open(temp_path, "wb") as f:
+                    f.write(png_bytes)
+                os.replace(temp_path, image_path)
+            if preprocess_config is not None:
+                # The full-size PNG is only encoded when it is kept, so only then is there a baseline to compare with
+                if png_bytes is not None:
+                    logging.info(report_savings(image_path, len(png_bytes), len(image_bytes)))
+                else:
+                    logging.info(f"Preprocessed {image_path}: {len(image_bytes)} bytes")
+            # Blocks while the queue is full, which holds rendering back to the pace of OCR
+            page_queue.put((pdf_file, image_path, get_text_path(pdf_file, text_directory, page_number), image_bytes, mime_type))
+
+        if keep_pngs and manifest is not None:
+            page_numbers = [page[0] for page in pages]
+            image_paths = [get_image_path(pdf_file, image_directory, page) for page in page_numbers]
+            manifest.record_pages(pdf_file, page_numbers, "done", image_paths)
+
+    def drain(futures):
+        for future in futures:
+            pdf_file, first_page, last_page = futures_info.pop(future)
+            expected = last_page - first_page + 1
+            try:
+                pages, elapsed = future.result()
+            except Exception as e:
+                logging.error(f"Error rendering pages {first_page}-{last_page} of {pdf_file}: {e}")
+                pages = []
+            for page in pages:
+                metrics.record("render", elapsed / len(pages), get_image_path(pdf_file, image_directory, page[0]))
+            # Pages that failed to render will not reach the OCR workers
+            if len(pages) < expected:
+                pages_done(pdf_file, expected - len(pages))
+            if pages:
+                enqueue_pages(pdf_file, pages)
+
+    try:
+        with ProcessPoolExecutor(max_workers=render_workers) as executor:
+            for pdf_file in pdf_files:
+                try:
+                    total_pages = get_page_count(pdf_file)
+                except Exception as e:
+                    logging.error(f"Error processing {pdf_file}: {e}")
+                    continue
+
+                os.makedirs(os.path.dirname(get_text_path(pdf_file, text_directory, 1)), exist_ok=True)
+                if keep_pngs:
+                    os.makedirs(os.path.dirname(get_image_path(pdf_file, image_directory, 1)), exist_ok=True)
+
+                # Pages with text output, or known to fail OCR, are not rendered at all
+                done_pages = {
+                    page for page in range(1, total_pages + 1)
+                    if os.path.exists(get_text_path(pdf_file, text_directory, page))
+                    or get_image_path(pdf_file, image_directory, page) in unfinished_files
+                }
+                ranges = find_missing_ranges(done_pages, total_pages, chunk_size)
+                logging.info(f"Total pages in {pdf_file}: {total_pages}, {len(ranges)} range(s) to render")
+
+                with pending_lock:
+                    pending_pages[pdf_file] = sum(last - first + 1 for first, last in ranges)
+                if not ranges and on_pdf_done is not None:
+                    on_pdf_done(pdf_file)
+
+                for first_page, last_page in ranges:
+                    if len(futures_info) >= max_pending:
+                        done, _ = wait(list(futures_info), return_when=FIRST_COMPLETED)
+                        drain(done)
+                    future = executor.submit(render_page_range_to_buffers, pdf_file, first_page, last_page,
+                                             preprocess_config, keep_pngs)
+                    futures_info[future] = (pdf_file, first_page, last_page)
+
+            while futures_info:
+                done, _ = wait(list(futures_info), return_when=FIRST_COMPLETED)
+                drain(done)
+    finally:
+        for _ in workers:
+            page_queue.put(None)
+        for worker in workers:
+            worker.join()
+
+    logging.info(f"Processed pages: {counts['processed']}")
+    logging.info(f"Pages without text: {counts['failed']}")
+    if cache is not None:
+        logging.info(cache.stats())
+
+# Input and output locations
+pdf_directory = "./pdfs/"
+image_directory = "./output_images/"
+text_directory = "./output_text/"
+csv_path = "./unfinished_files.csv"
+cache_path = "./ocr_cache.sqlite"
+manifest_file = "manifest_pdftopng.sqlite"
+
+# Rendering settings: worker processes (None uses every core) and pages per poppler call
+render_workers = None
+chunk_size = 10
+
+# OCR settings: concurrent OCR threads, rendered pages held in memory, and quota limits
+ocr_workers = 8
+queue_depth = 32
+requests_per_minute = 1000
+tokens_per_minute = 4000000
+estimated_tokens_per_page = 1500
+
+# Also write the rendered PNGs to image_directory
+keep_pngs = False
+
+# Set to preprocess.preprocess_config to shrink pages before OCR. It is lossy (lower DPI, grayscale, JPEG),
+# so check with preprocess.py --ocr that the text comes out the same before turning it on.
+page_preprocess_config = None
+
+# Per-page latencies and token counts are appended to the trace; set a port to expose them to Prometheus
+metrics_trace_file = "./metrics/pdftotext.jsonl"
+metrics_summary_file = "./metrics/pdftotext_summary.json"
+prometheus_port = None
+
+if __name__ == "__main__":
+    metrics.configure(metrics_trace_file, prometheus_port)
+    limiter = RateLimiter(requests_per_minute, tokens_per_minute)
+    cache = OCRCache(cache_path)
+    manifest = PageManifest(manifest_file) if keep_pngs else None
+
+    process_pdfs_to_text(pdf_directory, image_directory, text_directory, csv_path, render_workers=render_workers,
+                         chunk_size=chunk_size, ocr_workers=ocr_workers, queue_depth=queue_depth, keep_pngs=keep_pngs,
+                         limiter=limiter, estimated_tokens=estimated_tokens_per_page, cache=cache, manifest=manifest,
+                         preprocess_config=page_preprocess_config)
+
+    cache.close()
+    if manifest is not None:
+        manifest.close()
+    metrics.report(metrics_summary_file)
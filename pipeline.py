@@ -0,0 +1,280 @@
+import os
+import glob
+import queue
+import hashlib
+import logging
+import sqlite3
+import threading
+from datetime import datetime
+import typos
+import pdftotext
+from correction_manifest import CorrectionManifest, rules_version
+from entity_sink import open_sink
+from metrics import metrics
+from ocr_cache import OCRCache
+from pdftopng import find_pdfs, get_page_count, get_image_path
+from ratelimit import RateLimiter
+from retry_unfinished import load_unfinished_rows, write_unfinished_rows
+from text_loader import read_text_segments
+
+# Upstream stages of every stage. "ocr" renders and OCRs a PDF; the others work on its text pages.
+stage_graph = {
+    "ocr": [],
+    "correct": ["ocr"],
+    "ner": ["correct"],
+}
+
+def stage_order(graph):
+    """Return the stages in dependency order."""
+    order = []
+    remaining = dict(graph)
+    while remaining:
+        ready = [stage for stage, upstream in remaining.items() if all(dep in order for dep in upstream)]
+        if not ready:
+            raise ValueError(f"Stage graph has a cycle between: {', '.join(remaining)}")
+        for stage in sorted(ready):
+            order.append(stage)
+            del remaining[stage]
+    return order
+
+def make_key(*parts):
+    return hashlib.sha256("\0".join(parts).encode("utf-8")).hexdigest()
+
+def pdf_fingerprint(pdf_path):
+    stat = os.stat(pdf_path)
+    return f"{stat.st_size}:{stat.st_mtime_ns}"
+
+class PipelineState:
+    """Records, per stage and PDF, the key of the inputs the stage last completed with.
+
+    A stage's key is derived from the keys of its upstream stages and its own settings, so a new or
+    changed PDF, more OCR pages, or new correction rules change the keys of every stage downstream.
+    """
+
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            """CREATE TABLE IF NOT EXISTS stages (
+                stage TEXT NOT NULL,
+                pdf_path TEXT NOT NULL,
+                input_key TEXT NOT NULL,
+                status TEXT NOT NULL,
+                completed_at TEXT NOT NULL,
+                page_count INTEGER,
+                PRIMARY KEY (stage, pdf_path)
+            )"""
+        )
+        # State files from before page counts were recorded
+        columns = [row[1] for row in self.conn.execute("PRAGMA table_info(stages)")]
+        if "page_count" not in columns:
+            self.conn.execute("ALTER TABLE stages ADD COLUMN page_count INTEGER")
+        self.conn.commit()
+
+    def get(self, stage, pdf_path):
+        """Return (input key, status, page count) of the stage's last run on the PDF, or None."""
+        with self.lock:
+            return self.conn.execute(
+                "SELECT input_key, status, page_count FROM stages WHERE stage = ? AND pdf_path = ?", (stage, pdf_path)
+            ).fetchone()
+
+    def record(self, stage, pdf_path, input_key, status="complete", page_count=None):
+        with self.lock:
+            with self.conn:
+                self.conn.execute(
+                    "INSERT OR REPLACE INTO stages (stage, pdf_path, input_key, status, completed_at, page_count) VALUES (?, ?, ?, ?, ?, ?)",
+                    (stage, pdf_path, input_key, status, datetime.now().isoformat(), page_count),
+                )
+
+    def close(self):
+        self.conn.close()
+
+class PipelineRunner:
+    """Runs the stages over the PDFs that need them, overlapping OCR with the stages after it.
+
+    Rendering and OCR stream through pdftotext.py. As soon as every page of a PDF has been OCRed, the
+    PDF is handed to a downstream thread that runs the remaining stages on its text pages while other
+    PDFs are still rendering.
+    """
+
+    def __init__(self, settings):
+        self.settings = settings
+        self.state = PipelineState(settings["state_file"])
+        self.rules = typos.load_rules(settings["rules_file"])
+        self.stage_versions = {
+            "correct": rules_version(self.rules),
+            "ner": ",".join(settings["ner_engines"]),
+        }
+        self.stage_functions = {
+            "correct": self.run_correct,
+            "ner": self.run_ner,
+        }
+        self.models = {}
+
+    def text_files(self, pdf_path, total_pages=None):
+        """Return the text pages of the PDF that exist, and its total number of pages.
+
+        The page count is read from the PDF unless it is given, e.g. from the OCR record of an unchanged PDF.
+        """
+        if total_pages is None:
+            total_pages = get_page_count(pdf_path)
+        paths = [pdftotext.get_text_path(pdf_path, self.settings["text_directory"], page) for page in range(1, total_pages + 1)]
+        return [path for path in paths if os.path.exists(path)], total_pages
+
+    def invalidate_outputs(self, pdf_path):
+        """Remove the text pages and unfinished records of a PDF whose content changed, so it is OCRed again."""
+        first_text = pdftotext.get_text_path(pdf_path, self.settings["text_directory"], 1)
+        prefix = first_text[:-len("1.txt")]
+        for path in glob.glob(glob.escape(prefix) + "*.txt"):
+            if path[len(prefix):-4].isdigit():
+                os.remove(path)
+
+        rows = load_unfinished_rows(self.settings["csv_path"])
+        first_image = get_image_path(pdf_path, self.settings["image_directory"], 1)
+        image_prefix = first_image[:-len("1.png")]
+        kept = {path: reason for path, reason in rows.items() if not path.startswith(image_prefix)}
+        if len(kept) != len(rows):
+            write_unfinished_rows(self.settings["csv_path"], kept)
+
+    def run_correct(self, pdf_path, text_files):
+        typos.process_files(text_files, self.rules, self.correct_executor, manifest=self.correction_manifest)
+
+    def run_ner(self, pdf_path, text_files):
+        subfolder_name = os.path.basename(os.path.dirname(pdf_path))
+        pdf_name = os.path.basename(pdf_path)[:-4]
+        for engine in self.settings["ner_engines"]:
+            output_file = os.path.join(self.settings["entity_directory"], engine, subfolder_name, f"{pdf_name}.jsonl")
+            sink = open_sink(output_file)
+            try:
+                if engine == "spacy":
+                    import spacy_entityextraction
+                    spacy_entityextraction.process_texts(self.model("spacy"), read_text_segments(text_files), sink,
+                                                         batch_size=spacy_entityextraction.batch_size)
+                elif engine == "hf":
+                    import huggingface_entityextraction as hf
+                    hf.process_texts(self.model("hf"), read_text_segments(text_files), sink, batch_size=hf.batch_size,
+                                     max_tokens=hf.max_window_tokens, stride=hf.window_stride)
+            finally:
+                sink.close()
+
+    def model(self, engine):
+        """Load an NER model the first time it is needed and keep it for the rest of the run."""
+        if engine not in self.models:
+            if engine == "spacy":
+                import spacy_entityextraction
+                self.models[engine] = spacy_entityextraction.load_model()
+            else:
+                import huggingface_entityextraction as hf
+                self.models[engine] = hf.load_pipeline(hf.model_name, hf.backend)
+        return self.models[engine]
+
+    def run_downstream(self, pdf_path):
+        """Record the OCR result of a PDF and run every later stage whose inputs changed."""
+        fingerprint = pdf_fingerprint(pdf_path)
+        recorded = self.state.get("ocr", pdf_path)
+        known_pages = recorded[2] if recorded is not None and recorded[0] == fingerprint else None
+        text_files, total_pages = self.text_files(pdf_path, known_pages)
+        ocr_status = "complete" if len(text_files) == total_pages else "partial"
+        self.state.record("ocr", pdf_path, fingerprint, ocr_status, total_pages)
+
+        # The OCR output key changes whenever more pages have text
+        keys = {"ocr": make_key(fingerprint, str(len(text_files)))}
+        for stage in stage_order(stage_graph):
+            if stage == "ocr":
+                continue
+            keys[stage] = make_key(self.stage_versions[stage], *(keys[upstream] for upstream in stage_graph[stage]))
+            recorded = self.state.get(stage, pdf_path)
+            if recorded is not None and recorded[0] == keys[stage]:
+                continue
+
+            logging.info(f"Running {stage} on {len(text_files)} page(s) of {pdf_path}")
+            self.stage_functions[stage](pdf_path, text_files)
+            self.state.record(stage, pdf_path, keys[stage])
+
+    def downstream_worker(self, pdf_queue):
+        # SQLite connections and the correction pool belong to this thread
+        self.correction_manifest = CorrectionManifest(self.settings["correction_manifest_file"])
+        self.correct_executor = typos.create_executor(self.rules, self.settings["correct_workers"])
+        try:
+            while True:
+                pdf_path = pdf_queue.get()
+                if pdf_path is None:
+                    break
+                try:
+                    self.run_downstream(pdf_path)
+                except Exception as e:
+                    logging.error(f"Downstream stages failed for {pdf_path}: {e}")
+        finally:
+            self.correct_executor.shutdown()
+            self.correction_manifest.close()
+
+    def run(self):
+        settings = self.settings
+        pdf_files = find_pdfs(settings["pdf_directory"])
+        logging.info(f"Found {len(pdf_files)} PDF files in directory '{settings['pdf_directory']}'")
+
+        pdf_queue = queue.Queue()
+        downstream = threading.Thread(target=self.downstream_worker, args=(pdf_queue,))
+        downstream.start()
+
+        to_ocr = []
+        for pdf_path in pdf_files:
+            recorded = self.state.get("ocr", pdf_path)
+            fingerprint = pdf_fingerprint(pdf_path)
+            if recorded is not None and recorded[0] == fingerprint and recorded[1] == "complete":
+                pdf_queue.put(pdf_path)  # Later stages may still need to run, e.g. after a rule change
+                continue
+            if recorded is not None and recorded[0] != fingerprint:
+                logging.info(f"{pdf_path} changed since it was last processed")
+                self.invalidate_outputs(pdf_path)
+            to_ocr.append(pdf_path)
+
+        logging.info(f"{len(to_ocr)} PDF(s) need rendering and OCR")
+        try:
+            if to_ocr:
+                limiter = RateLimiter(settings["requests_per_minute"], settings["tokens_per_minute"])
+                cache = OCRCache(settings["cache_path"])
+                pdftotext.process_pdfs_to_text(
+                    settings["pdf_directory"], settings["image_directory"], settings["text_directory"],
+                    settings["csv_path"], render_workers=settings["render_workers"], chunk_size=settings["chunk_size"],
+                    ocr_workers=settings["ocr_workers"], queue_depth=settings["queue_depth"], limiter=limiter,
+                    estimated_tokens=settings["estimated_tokens_per_page"], cache=cache,
+                    preprocess_config=settings["preprocess_config"], pdf_files=to_ocr, on_pdf_done=pdf_queue.put,
+                )
+                cache.close()
+        finally:
+            pdf_queue.put(None)
+            downstream.join()
+            self.state.close()
+
+# Pipeline settings
+pipeline_settings = {
+    "pdf_directory": "./pdfs/",
+    "image_directory": "./output_images/",
+    "text_directory": "./output_text/",
+    "entity_directory": "./output_entities/",
+    "csv_path": "./unfinished_files.csv",
+    "cache_path": "./ocr_cache.sqlite",
+    "state_file": "./pipeline_state.sqlite",
+    "correction_manifest_file": "./manifest_typos.sqlite",
+    "rules_file": os.path.join(os.path.dirname(os.path.abspath(__file__)), "typo_rules.tsv"),
+    "render_workers": None,
+    "chunk_size": 10,
+    "ocr_workers": 8,
+    "queue_depth": 32,
+    "requests_per_minute": 1000,
+    "tokens_per_minute": 4000000,
+    "estimated_tokens_per_page": 1500,
+    "preprocess_config": None,  # Lossy page shrinking before OCR, see preprocess.py; off until verified on the corpus
+    "correct_workers": 2,
+    "ner_engines": ["spacy"],  # Add "hf" to also run the Hugging Face model
+    "metrics_trace_file": "./metrics/pipeline.jsonl",
+    "metrics_summary_file": "./metrics/pipeline_summary.json",
+    "prometheus_port": None,  # Set a port to expose the stage metrics to Prometheus while the pipeline runs
+}
+
+if __name__ == "__main__":
+    metrics.configure(pipeline_settings["metrics_trace_file"], pipeline_settings["prometheus_port"])
+    PipelineRunner(pipeline_settings).run()
+    metrics.report(pipeline_settings["metrics_summary_file"])
@@ -0,0 +1,121 @@
+import io
+import os
+import sys
+import difflib
+from PIL import Image
+
+# Preprocessing settings applied between rendering and OCR
+preprocess_config = {
+    "dpi": 150,                # Target resolution; pages rendered at a higher DPI are scaled down
+    "mode": "grayscale",       # "color", "grayscale" or "bilevel"
+    "bilevel_threshold": 160,  # Gray level above which a pixel becomes white in bilevel mode
+    "crop_whitespace": True,   # Trim blank margins around the page content
+    "crop_margin": 10,         # Pixels of margin kept around the content when cropping
+    "format": "JPEG",          # "PNG", "JPEG" or "WEBP"
+    "quality": 75,             # Encoder quality for JPEG and WEBP
+}
+
+mime_types = {
+    "PNG": "image/png",
+    "JPEG": "image/jpeg",
+    "WEBP": "image/webp",
+}
+
+# pdf2image renders at 200 DPI unless told otherwise
+default_render_dpi = 200
+
+def crop_whitespace(image, margin=0):
+    """Crop the near-white margins around the content of the page."""
+    gray = image.convert("L")
+    mask = gray.point(lambda p: 255 if p < 245 else 0)
+    bbox = mask.getbbox()
+    if bbox is None:
+        return image  # Blank page, nothing to crop to
+    left, top, right, bottom = bbox
+    return image.crop((max(0, left - margin), max(0, top - margin),
+                       min(image.width, right + margin), min(image.height, bottom + margin)))
+
+def preprocess_image(image, config, source_dpi=default_render_dpi):
+    """Apply the preprocessing settings to a PIL image and return the encoded bytes and MIME type."""
+    target_dpi = config.get("dpi")
+    if target_dpi and target_dpi < source_dpi:
+        scale = target_dpi / source_dpi
+        image = image.resize((max(1, round(image.width * scale)), max(1, round(image.height * scale))), Image.LANCZOS)
+
+    if config.get("crop_whitespace"):
+        image = crop_whitespace(image, config.get("crop_margin", 0))
+
+    mode = config.get("mode", "color")
+    if mode == "grayscale":
+        image = image.convert("L")
+    elif mode == "bilevel":
+        threshold = config.get("bilevel_threshold", 160)
+        image = image.convert("L").point(lambda p: 255 if p > threshold else 0, mode="1")
+    elif image.mode not in ("RGB", "L"):
+        image = image.convert("RGB")
+
+    image_format = config.get("format", "PNG").upper()
+    if image_format in ("JPEG", "WEBP") and image.mode == "1":
+        image = image.convert("L")  # Lossy encoders don't take 1-bit images
+
+    buffer = io.BytesIO()
+    if image_format == "PNG":
+        image.save(buffer, "PNG", optimize=True)
+    else:
+        image.save(buffer, image_format, quality=config.get("quality", 75))
+    return buffer.getvalue(), mime_types[image_format]
+
+def preprocess_bytes(image_bytes, config, source_dpi=default_render_dpi):
+    """Preprocess an encoded image and return the new bytes and MIME type."""
+    with Image.open(io.BytesIO(image_bytes)) as image:
+        image.load()
+        return preprocess_image(image, config, source_dpi)
+
+def report_savings(label, original_size, new_size):
+    """Return a one-line summary of the bytes saved on a page."""
+    saved = original_size - new_size
+    percent = (saved / original_size * 100) if original_size else 0.0
+    return f"Preprocessed {label}: {original_size} -> {new_size} bytes ({saved} bytes, {percent:.1f}% saved)"
+
+def benchmark(directory, config, compare_ocr=False, limit=20):
+    """Compare payload sizes, and optionally OCR output, of original and preprocessed sample pages."""
+    samples = []
+    for root, _, files in os.walk(directory):
+        samples.extend(os.path.join(root, f) for f in sorted(files) if f.endswith('.png'))
+    samples = samples[:limit]
+
+    if compare_ocr:
+        import geminiocr
+
+        def ocr_text(image_bytes, mime_type, label):
+            part = {"mime_type": mime_type, "data": image_bytes}
+            response = geminiocr.generate_with_limits([part, "\n\n", geminiocr.ocr_prompt], label)
+            return response.candidates[0].content.parts[0].text if response.candidates else ""
+
+    total_original = 0
+    total_new = 0
+    similarities = []
+    for image_path in samples:
+        with open(image_path, "rb") as f:
+            original = f.read()
+        processed, mime_type = preprocess_bytes(original, config)
+        total_original += len(original)
+        total_new += len(processed)
+        print(report_savings(image_path, len(original), len(processed)))
+
+        if compare_ocr:
+            baseline_text = ocr_text(original, "image/png", image_path)
+            processed_text = ocr_text(processed, mime_type, image_path)
+            similarity = difflib.SequenceMatcher(None, baseline_text, processed_text).ratio()
+            similarities.append(similarity)
+            print(f"  OCR similarity to the original page: {similarity:.3f}")
+
+    print(f"Pages: {len(samples)}")
+    print(report_savings("total", total_original, total_new))
+    if similarities:
+        print(f"Mean OCR similarity: {sum(similarities) / len(similarities):.3f}, worst: {min(similarities):.3f}")
+
+if __name__ == "__main__":
+    # Usage: python preprocess.py [image_directory] [--ocr]
+    sample_directory = sys.argv[1] if len(sys.argv) > 1 and not sys.argv[1].startswith("--") else "./output_images/"
+    benchmark(sample_directory, preprocess_config, compare_ocr="--ocr" in sys.argv)
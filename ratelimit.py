@@ -0,0 +1,118 @@
+import time
+import random
+import logging
+import threading
+from metrics import metrics
+
+# Errors of the Google API client worth retrying; without the client only the status code is checked
+try:
+    from google.api_core.exceptions import DeadlineExceeded, InternalServerError, ResourceExhausted, ServiceUnavailable
+    retryable_error_types = (ResourceExhausted, ServiceUnavailable, InternalServerError, DeadlineExceeded)
+    throttling_error_types = (ResourceExhausted,)
+except ImportError:
+    retryable_error_types = ()
+    throttling_error_types = ()
+
+class TokenBucket:
+    """Thread-safe token bucket that refills continuously up to its capacity."""
+
+    def __init__(self, rate_per_minute, capacity=None):
+        self.rate = rate_per_minute / 60.0
+        self.capacity = capacity if capacity is not None else rate_per_minute
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self, amount=1):
+        """Block until the given amount can be taken from the bucket, then take it."""
+        # Requests larger than the bucket would never fit, so they only wait for a full bucket
+        amount = min(amount, self.capacity)
+        waited = 0.0
+        while True:
+            with self.lock:
+                self._refill()
+                if self.tokens >= amount:
+                    self.tokens -= amount
+                    break
+                wait = (amount - self.tokens) / self.rate
+            time.sleep(wait)
+            waited += wait
+        if waited:
+            metrics.count("rate_limit_wait_seconds", waited)
+
+    def adjust(self, amount):
+        """Take (or give back, if negative) tokens without blocking, e.g. to settle an estimate."""
+        with self.lock:
+            self._refill()
+            self.tokens = min(self.capacity, self.tokens - amount)
+
+class RateLimiter:
+    """Limits both requests per minute and tokens per minute."""
+
+    def __init__(self, requests_per_minute, tokens_per_minute=None):
+        self.requests = TokenBucket(requests_per_minute)
+        self.tokens = TokenBucket(tokens_per_minute) if tokens_per_minute else None
+
+    def acquire(self, estimated_tokens=0):
+        """Wait for a request slot and for the estimated number of tokens."""
+        self.requests.acquire(1)
+        if self.tokens is not None and estimated_tokens:
+            self.tokens.acquire(estimated_tokens)
+
+    def settle(self, estimated_tokens, actual_tokens):
+        """Correct the token bucket once the real token usage of a request is known."""
+        if self.tokens is not None and actual_tokens is not None:
+            self.tokens.adjust(actual_tokens - estimated_tokens)
+
+def error_status_code(error):
+    """Return the HTTP status code of an API error, or None.
+
+    google.api_core errors carry it in code; the googleapiclient HttpError raised by file uploads carries it
+    in status_code and resp.status instead.
+    """
+    for code in (getattr(error, "code", None), getattr(error, "status_code", None),
+                 getattr(getattr(error, "resp", None), "status", None)):
+        try:
+            return int(code)
+        except (TypeError, ValueError):
+            continue
+    return None
+
+def is_retryable_error(error):
+    """Return True for throttling (429) and server-side (5xx) errors.
+
+    Only the exception type and its HTTP status code are trusted; error messages can contain any number,
+    for example a file name like page_429.png.
+    """
+    if isinstance(error, retryable_error_types):
+        return True
+    code = error_status_code(error)
+    return code is not None and (code == 429 or 500 <= code < 600)
+
+def is_throttling_error(error):
+    """Return True for rate limit (429) errors."""
+    return isinstance(error, throttling_error_types) or error_status_code(error) == 429
+
+def call_with_retry(func, *args, max_retries=6, base_delay=1.0, max_delay=60.0, description=None, **kwargs):
+    """Call func, retrying retryable errors with jittered exponential backoff."""
+    attempt = 0
+    while True:
+        try:
+            return func(*args, **kwargs)
+        except Exception as e:
+            if attempt >= max_retries or not is_retryable_error(e):
+                raise
+            metrics.count("retries")
+            if is_throttling_error(e):
+                metrics.count("throttles")
+            # Full jitter keeps concurrent workers from retrying in lockstep
+            delay = random.uniform(0, min(max_delay, base_delay * (2 ** attempt)))
+            attempt += 1
+            logging.warning(f"Retryable error for {description or func.__name__} "
+                            f"(attempt {attempt}/{max_retries}), retrying in {delay:.1f}s: {e}")
+            time.sleep(delay)
@@ -0,0 +1,166 @@
+import io
+import os
+import re
+import csv
+import argparse
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from pdf2image import convert_from_path
+import geminiocr
+from pdftopng import find_pdfs
+from ocr_cache import OCRCache
+from ratelimit import RateLimiter
+
+# Lower numbers are retried first: truncated pages are the most likely to succeed with tiling,
+# errors are often transient, and safety or recitation stops rarely change on a retry
+reason_priorities = [
+    ("MAX_TOKENS", 0),
+    ("Unexpected error", 1),
+    ("No valid candidates", 1),
+    ("Unspecified", 2),
+    ("OTHER", 2),
+    ("Unknown", 2),
+    ("SAFETY", 3),
+    ("RECITATION", 3),
+]
+
+page_pattern = re.compile(r"^(.*)_page_(\d+)\.png$")
+
+def reason_priority(reason):
+    for marker, priority in reason_priorities:
+        if marker in reason:
+            return priority
+    return 2
+
+def load_unfinished_rows(csv_path):
+    """Return the latest recorded reason for every unfinished page, in file order."""
+    rows = {}
+    if os.path.exists(csv_path):
+        with open(csv_path, "r", newline='') as csvfile:
+            for row in csv.reader(csvfile):
+                if len(row) > 0:
+                    rows[row[0]] = row[1] if len(row) > 1 else ""
+    return rows
+
+def write_unfinished_rows(csv_path, rows):
+    """Rewrite the unfinished pages CSV atomically."""
+    temp_path = f"{csv_path}.tmp"
+    with open(temp_path, "w", newline='') as csvfile:
+        log_writer = csv.writer(csvfile)
+        for image_path, reason in rows.items():
+            log_writer.writerow([image_path, reason])
+    os.replace(temp_path, csv_path)
+
+def build_pdf_index(pdf_directory):
+    """Map (subfolder, PDF name without extension) to the PDF path, as pdftopng.py lays out its images."""
+    index = {}
+    for pdf_path in find_pdfs(pdf_directory):
+        subfolder_name = os.path.basename(os.path.dirname(pdf_path))
+        index[(subfolder_name, os.path.basename(pdf_path)[:-4])] = pdf_path
+    return index
+
+def render_page_bytes(image_path, pdf_index):
+    """Render the page behind an image path from its PDF, for pages that were never written to disk."""
+    match = page_pattern.match(os.path.basename(image_path))
+    if match is None:
+        return None
+    subfolder_name = os.path.basename(os.path.dirname(image_path))
+    pdf_path = pdf_index.get((subfolder_name, match.group(1)))
+    if pdf_path is None:
+        return None
+
+    page_number = int(match.group(2))
+    images = convert_from_path(pdf_path, first_page=page_number, last_page=page_number)
+    buffer = io.BytesIO()
+    images[0].save(buffer, 'PNG')
+    return buffer.getvalue()
+
+def retry_page(image_path, reason, image_directory, output_directory, retry_csv_path, limiter, estimated_tokens, cache, pdf_index):
+    """Retry one unfinished page. Returns True once the page has text output."""
+    output_file = os.path.join(output_directory, os.path.relpath(image_path, image_directory))[:-4] + ".txt"
+    if os.path.exists(output_file):
+        return True
+    os.makedirs(os.path.dirname(output_file), exist_ok=True)
+
+    if os.path.exists(image_path):
+        with open(image_path, "rb") as f:
+            image_bytes = f.read()
+    else:
+        image_bytes = render_page_bytes(image_path, pdf_index)
+        if image_bytes is None:
+            logging.warning(f"Cannot find {image_path} or the PDF it came from, skipping")
+            return False
+
+    if "MAX_TOKENS" in reason and geminiocr.tile_settings["enabled"]:
+        # The page is known to be too dense for one request, so go straight to tiles
+        logging.info(f"Retrying {image_path} in tiles")
+        text = geminiocr.ocr_tiled(image_path, image_bytes, limiter, estimated_tokens)
+        if text:
+            geminiocr.save_text(output_file, text)
+            return True
+        geminiocr.log_unfinished_file_csv(retry_csv_path, image_path, reason)
+        return False
+
+    logging.info(f"Retrying {image_path}")
+    return geminiocr.ocr_image(image_path, output_file, retry_csv_path, limiter, estimated_tokens, cache,
+                               "inline", image_bytes=image_bytes)
+
+def retry_unfinished(csv_path, image_directory, output_directory, pdf_directory, workers=8, limit=None,
+                     limiter=None, estimated_tokens=0, cache=None):
+    """Retry the pages recorded in the unfinished pages CSV in priority order, and drop the ones that succeed."""
+    rows = load_unfinished_rows(csv_path)
+    queue = sorted(rows.items(), key=lambda item: (reason_priority(item[1]), item[0]))
+    if limit is not None:
+        queue = queue[:limit]
+    logging.info(f"{len(rows)} unfinished page(s), retrying {len(queue)}")
+
+    # Failures during the retry are recorded separately and merged back at the end
+    retry_csv_path = f"{csv_path}.retry"
+    if os.path.exists(retry_csv_path):
+        os.remove(retry_csv_path)
+
+    pdf_index = build_pdf_index(pdf_directory)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        results = list(executor.map(
+            lambda item: retry_page(item[0], item[1], image_directory, output_directory, retry_csv_path,
+                                    limiter, estimated_tokens, cache, pdf_index),
+            queue,
+        ))
+
+    new_reasons = load_unfinished_rows(retry_csv_path)
+    resolved = 0
+    for (image_path, _), succeeded in zip(queue, results):
+        if succeeded:
+            del rows[image_path]
+            resolved += 1
+        elif image_path in new_reasons:
+            rows[image_path] = new_reasons[image_path]
+
+    write_unfinished_rows(csv_path, rows)
+    if os.path.exists(retry_csv_path):
+        os.remove(retry_csv_path)
+
+    logging.info(f"Resolved {resolved} page(s), {len(rows)} still unfinished")
+    if cache is not None:
+        logging.info(cache.stats())
+
+def main():
+    parser = argparse.ArgumentParser(description="Retry the pages listed in unfinished_files.csv in priority order.")
+    parser.add_argument("--csv", default="./unfinished_files.csv", help="Unfinished pages CSV written by geminiocr.py")
+    parser.add_argument("--images", default="./output_images/", help="Image directory the CSV paths point into")
+    parser.add_argument("--output", default="./output_text/", help="Text output directory")
+    parser.add_argument("--pdfs", default="./pdfs/", help="PDF directory, used to re-render pages whose PNG is missing")
+    parser.add_argument("--workers", type=int, default=8, help="Pages retried concurrently")
+    parser.add_argument("--limit", type=int, default=None, help="Retry at most this many pages")
+    parser.add_argument("--requests-per-minute", type=int, default=1000)
+    parser.add_argument("--tokens-per-minute", type=int, default=4000000)
+    args = parser.parse_args()
+
+    limiter = RateLimiter(args.requests_per_minute, args.tokens_per_minute)
+    cache = OCRCache("./ocr_cache.sqlite")
+    retry_unfinished(args.csv, args.images, args.output, args.pdfs, workers=args.workers, limit=args.limit,
+                     limiter=limiter, estimated_tokens=1500, cache=cache)
+    cache.close()
+
+if __name__ == "__main__":
+    main()
@@ -1,74 +1,84 @@
-import os
+import time
+from entity_sink import Entity, open_sink
+from metrics import metrics
+from text_loader import read_text_segments
 import spacy
-from collections import defaultdict
 
-# Load SpaCy's pre-trained NER model
-nlp = spacy.load("en_core_web_sm")
+# Components of en_core_web_sm that named entity recognition doesn't use
+unused_components = ["tagger", "parser", "attribute_ruler", "lemmatizer", "senter"]
+
+# Load SpaCy's pre-trained NER model with only the components NER needs
+def load_model(model_name="en_core_web_sm"):
+    nlp = spacy.load(model_name, exclude=unused_components)
+
+    # The shared tok2vec layer only feeds the excluded components unless NER listens to it
+    if "tok2vec" in nlp.pipe_names and not nlp.get_pipe("tok2vec").listening_components:
+        nlp.disable_pipe("tok2vec")
+
+    print(f"Loaded {model_name} with components: {', '.join(nlp.pipe_names)}")
+    return nlp
 
 # Define the root directory containing subfolders with text files
 root_directory = "./output_text"
 
-# Define output file
-output_file = "./output_entities/entities_by_type.txt"
+# Define output file; the format ("text", "jsonl" or "parquet") follows the extension
+output_file = "./output_entities/entities_by_type.jsonl"
 
-# Function to process a single text file and extract entities with metadata
-def process_file(file_path):
-    try:
-        with open(file_path, 'r', encoding='utf-8') as file:
-            text = file.read()
-        doc = nlp(text)
-
-        entities_with_metadata = []
-        for ent in doc.ents:
-            # Capture entity text, label, and context (file path and position)
-            entity_data = {
-                "entity": ent.text,
-                "label": ent.label_,
-                "file_path": file_path,
-                "start_char": ent.start_char,
-                "end_char": ent.end_char
-            }
-            entities_with_metadata.append(entity_data)
-        
-        return entities_with_metadata
-    except Exception as e:
-        print(f"Error processing file {file_path}: {e}")
-        return []
-
-# Function to process all text files in a directory (including subdirectories)
-def process_directory(directory_path):
-    all_entities = []
-
-    for subdir, _, files in os.walk(directory_path):
-        print(f"Processing {subdir}")
-        for file in files:
-            if file.endswith('.txt'):
-                file_path = os.path.join(subdir, file)
-                entities = process_file(file_path)
-                
-                # Add entities from the current file to the overall collection
-                all_entities.extend(entities)
-    
-    return all_entities
-
-# Function to handle file output
-def write_to_output_file(output_file, entities_with_metadata):
+# Batching settings for nlp.pipe: documents per batch and worker processes
+batch_size = 64
+n_process = 1
+
+# Function to extract entities with metadata from a processed document, offset being its position in the file
+def extract_entities(doc, file_path, offset=0):
+    # Capture entity text, label, and context (file path and position)
+    return [Entity(ent.text, ent.label_, file_path, ent.start_char + offset, ent.end_char + offset) for ent in doc.ents]
+
+# Function to process (text, file path, offset) segments in batches, writing the entities of each
+# segment to the sink as soon as it is done. Returns the number of segments and entities.
+def process_texts(nlp, segments, sink, batch_size=64, n_process=1):
+    doc_count = 0
+    entity_count = 0
+
+    # Documents come out of the pipe in batches, so the time since the previous document is each one's share
+    last_time = time.perf_counter()
+    texts = ((text, (file_path, offset)) for text, file_path, offset in segments)
+    for doc, (file_path, offset) in nlp.pipe(texts, as_tuples=True, batch_size=batch_size, n_process=n_process):
+        entities = extract_entities(doc, file_path, offset)
+        sink.write(entities)
+        entity_count += len(entities)
+        doc_count += 1
+
+        now = time.perf_counter()
+        metrics.record("ner", now - last_time, file_path, engine="spacy", entities=len(entities))
+        last_time = now
+
+    return doc_count, entity_count
+
+# Function to process all text files in a directory (including subdirectories) in batches
+def process_directory(nlp, directory_path, sink, batch_size=64, n_process=1):
+    start_time = time.perf_counter()
+
+    doc_count, entity_count = process_texts(nlp, read_text_segments(directory_path, verbose=True), sink, batch_size, n_process)
+
+    elapsed = time.perf_counter() - start_time
+    docs_per_second = doc_count / elapsed if elapsed > 0 else 0.0
+    print(f"Processed {doc_count} documents in {elapsed:.1f}s ({docs_per_second:.1f} docs/sec), {entity_count} entities")
+
+    return entity_count
+
+# Per-page NER latencies are appended to the trace and summarized at the end
+metrics_trace_file = "./metrics/spacy_entityextraction.jsonl"
+metrics_summary_file = "./metrics/spacy_entityextraction_summary.json"
+
+if __name__ == "__main__":
+    metrics.configure(metrics_trace_file)
+    nlp = load_model()
+
+    # Run the processing on the root directory, streaming the results to the output file
+    sink = open_sink(output_file)
     try:
-        # Ensure the directory exists
-        os.makedirs(os.path.dirname(output_file), exist_ok=True)
-        
-        # Write the entities with metadata to the output file
-        with open(output_file, 'w', encoding='utf-8') as f:
-            for entity_data in entities_with_metadata:
-                f.write(f"Entity: {entity_data['entity']}, Label: {entity_data['label']}, "
-                        f"File: {entity_data['file_path']}, "
-                        f"Position: ({entity_data['start_char']}, {entity_data['end_char']})\n")
-        print(f"Entities successfully written to {output_file}")
-    except Exception as e:
-        print(f"Error writing to file {output_file}: {e}")
-
-# Run the processing on the root directory
-entities_with_metadata = process_directory(root_directory)
-
-# Write the results to the output file
-write_to_output_file(output_file, entities_with_metadata)
\ No newline at end of file
+        process_directory(nlp, root_directory, sink, batch_size=batch_size, n_process=n_process)
+    finally:
+        sink.close()
+    print(f"Entities successfully written to {output_file}")
+    metrics.report(metrics_summary_file, output=print)
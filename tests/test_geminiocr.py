@@ -0,0 +1,31 @@
+import pytest
+
+pytest.importorskip("google.generativeai")
+pytest.importorskip("PIL")
+geminiocr = pytest.importorskip("geminiocr")
+
+def test_split_batch_response():
+    text = "=== PAGE 1 ===\nfirst page\n=== PAGE 2 ===\n\n=== PAGE 3 ===\nthird\npage\n"
+    assert geminiocr.split_batch_response(text, 3) == ["first page", "", "third\npage"]
+
+@pytest.mark.parametrize("text", [
+    "=== PAGE 1 ===\nfirst\n=== PAGE 2 ===\nsecond",  # A page missing
+    "=== PAGE 1 ===\nfirst\n=== PAGE 3 ===\nsecond\n=== PAGE 2 ===\nthird",  # Out of order
+    "Here are the pages:\n=== PAGE 1 ===\nfirst\n=== PAGE 2 ===\nsecond\n=== PAGE 3 ===\nthird",  # Text before the first marker
+    "first\nsecond\nthird",  # No markers
+])
+def test_split_batch_response_rejects_misaligned_markers(text):
+    assert geminiocr.split_batch_response(text, 3) is None
+
+def test_stitch_tile_texts_drops_overlapping_lines():
+    top = "line one\nline two\nline three is long\nline four is cut"
+    bottom = "line three is long\nline four is cut off here\nline five"
+    assert geminiocr.stitch_tile_texts([top, bottom]) == (
+        "line one\nline two\nline three is long\nline four is cut off here\nline five"
+    )
+
+def test_stitch_tile_texts_keeps_tiles_without_overlap():
+    assert geminiocr.stitch_tile_texts(["alpha\nbeta", "gamma\ndelta"]) == "alpha\nbeta\ngamma\ndelta"
+
+def test_stitch_tile_texts_ignores_blank_overlap():
+    assert geminiocr.stitch_tile_texts(["alpha\n", "\nbeta"]) == "alpha\n\nbeta"
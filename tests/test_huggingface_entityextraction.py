@@ -0,0 +1,39 @@
+import re
+import pytest
+
+pytest.importorskip("transformers")
+hf = pytest.importorskip("huggingface_entityextraction")
+
+def whitespace_tokenizer(text, add_special_tokens=False, return_offsets_mapping=True):
+    """Stand-in for a fast tokenizer: one token per word, with its character offsets."""
+    return {"offset_mapping": [match.span() for match in re.finditer(r"\S+", text)]}
+
+@pytest.mark.parametrize("word_count", [0, 1, 10, 99, 100, 101, 250, 1000])
+def test_windows_own_each_character_once(word_count):
+    text = " ".join(f"w{index}" for index in range(word_count))
+    windows = hf.split_into_windows(text, whitespace_tokenizer, max_tokens=100, stride=20)
+    if not word_count:
+        assert windows == []
+        return
+
+    # The owned ranges cover the text end to end, without gaps or overlaps
+    assert windows[0][2] == 0
+    assert windows[-1][3] == len(text)
+    for previous, following in zip(windows, windows[1:]):
+        assert previous[3] == following[2]
+
+    for window_start, window_end, owned_start, owned_end in windows:
+        assert window_start <= owned_start <= owned_end
+        # Tokens owned by a window are inside it, so every entity is found by the window that keeps it
+        owned_words = [span for span in whitespace_tokenizer(text)["offset_mapping"] if owned_start <= span[0] < owned_end]
+        assert all(window_start <= start and end <= window_end for start, end in owned_words)
+
+def test_split_texts_into_chunks_uses_file_positions():
+    text = " ".join(f"w{index}" for index in range(300))
+    chunks = list(hf.split_texts_into_chunks([(text, "a.txt", 1000)], whitespace_tokenizer, 100, 20))
+    for chunk_text, file_path, offset, owned_start, owned_end in chunks:
+        assert file_path == "a.txt"
+        assert text[offset - 1000:offset - 1000 + len(chunk_text)] == chunk_text
+        assert offset <= owned_start <= owned_end
+    assert chunks[0][3] == 1000
+    assert chunks[-1][4] == 1000 + len(text)
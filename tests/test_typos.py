@@ -0,0 +1,35 @@
+import io
+import random
+import pytest
+from typos import Corrector, Rule
+
+rules = [
+    Rule("literal", "CARL N. FREEMAN", "CARL N. FREYMAN"),
+    Rule("literal", "CARL H. FREEMAN", "CARL N. FREYMAN"),
+    Rule("literal", "teh", "the"),
+    Rule("literal", "FREE", "FREY"),
+    Rule("regex", r"\b[Rr][Uu][Ee][Yy]\b", "RUBY"),
+    Rule("regex", r"(\w)\1{3,}", r"\1"),  # Backreference, so it gets its own pass
+    Rule("regex", r"(?i)qq+", "Q"),  # Inline flag, so it gets its own pass
+    Rule("regex", r"(?<=Mr)\.", ""),
+]
+
+alphabet = ["CARL ", "N. ", "H. ", "FREEMAN", "FREE", "teh ", "ruey ", "RUEY", "aaaa", "qQq", "Mr.", " ", "\n", "x"]
+
+def random_text(rng, pieces):
+    return "".join(rng.choice(alphabet) for _ in range(pieces))
+
+@pytest.mark.parametrize("seed", range(20))
+def test_correct_stream_matches_correct(seed):
+    rng = random.Random(seed)
+    corrector = Corrector(rules)
+    text = random_text(rng, rng.randint(0, 400))
+    expected, expected_counts = corrector.correct(text)
+
+    # Chunks far smaller than the text put matches across every kind of boundary
+    target = io.StringIO()
+    counts = corrector.correct_stream(io.StringIO(text), target, chunk_size=rng.randint(1, 40),
+                                      overlap=32, context=16)
+
+    assert target.getvalue() == expected
+    assert counts == expected_counts
@@ -0,0 +1,55 @@
+import os
+
+# Function to list the text files in directories (including subdirectories) and explicit file paths
+def find_text_files(paths, verbose=False):
+    if isinstance(paths, str):
+        paths = [paths]
+    for path in paths:
+        if os.path.isfile(path):
+            yield path
+            continue
+        for subdir, _, files in os.walk(path):
+            if verbose:
+                print(f"Processing {subdir}")
+            for file in files:
+                if file.endswith('.txt'):
+                    yield os.path.join(subdir, file)
+
+# Files are fed to NER in segments of at most about this many characters, so a file concatenating a
+# whole document is never held in memory at once. Page-sized files fit in a single segment.
+segment_chars = 100000
+
+# Function to find where to end a segment: after the last paragraph break before the limit, or failing
+# that the last line break or space, so entities are rarely cut in two
+def find_segment_break(text, limit):
+    for separator in ("\n\n", "\n", " "):
+        index = text.rfind(separator, 0, limit)
+        if index >= limit // 2:
+            return index + len(separator)
+    return limit
+
+# Function to read an open text file as (text, offset) segments, offset being the segment's position in the file
+def iter_segments(file, max_chars=segment_chars):
+    offset = 0
+    pending = ""
+    while True:
+        chunk = file.read(max_chars)
+        pending += chunk
+        while len(pending) > max_chars:
+            cut = find_segment_break(pending, max_chars)
+            yield pending[:cut], offset
+            offset += cut
+            pending = pending[cut:]
+        if not chunk:
+            if pending:
+                yield pending, offset
+            return
+
+# Function to read text files lazily as (text, file path, offset) segments
+def read_text_segments(paths, max_chars=segment_chars, verbose=False):
+    for file_path in find_text_files(paths, verbose):
+        try:
+            with open(file_path, 'r', encoding='utf-8') as f:
+                yield from ((text, file_path, offset) for text, offset in iter_segments(f, max_chars))
+        except Exception as e:
+            print(f"Error processing file {file_path}: {e}")
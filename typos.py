@@ -1,46 +1,391 @@
 import os
 import re
+import sys
+import time
+import hashlib
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from correction_manifest import CorrectionManifest, hash_content, rules_version
+from metrics import metrics
 
-def replace_in_file(filename, replacements, counts):
-    with open(filename, 'r') as file:
-        content = file.read()
+class Rule:
+    """A single correction: literal text or a regular expression, and its replacement."""
 
-    for old, new in replacements:
-        # Count occurrences before replacing
-        occurrences = len(re.findall(old, content))
-        counts[old] += occurrences
-        
-        # Perform the replacement
-        content = re.sub(old, new, content)
+    def __init__(self, kind, pattern, replacement):
+        self.kind = kind
+        self.pattern = pattern
+        self.replacement = replacement
+        self.regex = re.compile(pattern) if kind == "regex" else None
 
-    with open(filename, 'w') as file:
-        file.write(content)
+def load_rules(rules_file):
+    """Load rules from a tab-separated file of type, pattern and replacement. Blank lines and # comments are skipped."""
+    rules = []
+    with open(rules_file, 'r', encoding='utf-8') as file:
+        for line_number, line in enumerate(file, start=1):
+            line = line.rstrip('\n')
+            if not line.strip() or line.startswith('#'):
+                continue
+            fields = line.split('\t')
+            if len(fields) != 3 or fields[0] not in ("literal", "regex"):
+                raise ValueError(f"{rules_file}:{line_number}: expected 'literal' or 'regex', a pattern and a replacement separated by tabs")
+            rules.append(Rule(*fields))
+    return rules
 
-def process_directory(directory, replacements):
-    counts = {old: 0 for old, _ in replacements}
-    
+def build_trie_pattern(words):
+    """Build a regular expression from a trie of the words, so shared prefixes are only matched once.
+
+    Longer words win over their own prefixes, as the trie tries to continue before accepting a word end.
+    """
+    trie = {}
+    for word in words:
+        node = trie
+        for char in word:
+            node = node.setdefault(char, {})
+        node[''] = True
+
+    def to_pattern(node):
+        ends_here = '' in node
+        branches = [re.escape(char) + to_pattern(child) for char, child in sorted(node.items()) if char != '']
+        if not branches:
+            return ''
+        body = branches[0] if len(branches) == 1 else '(?:' + '|'.join(branches) + ')'
+        if ends_here:
+            return '(?:' + body + ')?'
+        return body
+
+    return to_pattern(trie)
+
+def needs_own_pass(rule):
+    """Return True for regex rules that can't be combined with others: capture groups would be renumbered
+    (breaking numbered backreferences) and inline global flags are only valid at the start of a pattern."""
+    return rule.kind == "regex" and (rule.regex.groups > 0 or rule.regex.flags != re.compile("").flags)
+
+class CombinedPass:
+    """Applies a run of literal and simple regex rules in a single scan of the text.
+
+    The literals are compiled into one trie pattern and combined with the regex rules into a single
+    alternation. Where rules overlap, the leftmost match wins; replacements are not rescanned.
+    """
+
+    def __init__(self, rules, indexes):
+        self.rules = rules
+        self.literals = {rules[index].pattern: index for index in indexes if rules[index].kind == "literal"}
+
+        alternatives = []
+        if self.literals:
+            alternatives.append(f"(?P<literal>{build_trie_pattern(self.literals)})")
+        for index in indexes:
+            if rules[index].kind == "regex":
+                alternatives.append(f"(?P<r{index}>{rules[index].pattern})")
+        self.pattern = re.compile('|'.join(alternatives))
+
+    def replacement(self, match, counts):
+        """Return the replacement for a match and count it for its rule."""
+        if match.lastgroup == "literal":
+            index = self.literals[match.group()]
+            counts[index] += 1
+            return self.rules[index].replacement
+
+        index = int(match.lastgroup[1:])
+        counts[index] += 1
+        # Re-match the rule on its own at the same position so escapes in its replacement are expanded
+        rule_match = self.rules[index].regex.match(match.string, match.start())
+        return rule_match.expand(self.rules[index].replacement)
+
+class RulePass:
+    """Applies one regex rule that needs its own scan, with its groups, backreferences and flags intact."""
+
+    def __init__(self, rules, index):
+        self.rule = rules[index]
+        self.index = index
+        self.pattern = self.rule.regex
+
+    def replacement(self, match, counts):
+        counts[self.index] += 1
+        return match.expand(self.rule.replacement)
+
+class Corrector:
+    """Applies every rule with as few scans of the text as possible.
+
+    Consecutive literal and simple regex rules share one scan; regex rules with capture groups or inline
+    flags get a scan of their own. The scans run in rule order, each on the output of the previous one.
+    """
+
+    def __init__(self, rules):
+        self.rules = rules
+        self.passes = []
+        simple = []
+        for index, rule in enumerate(rules):
+            if not needs_own_pass(rule):
+                simple.append(index)
+                continue
+            if simple:
+                self.passes.append(CombinedPass(rules, simple))
+                simple = []
+            self.passes.append(RulePass(rules, index))
+        if simple:
+            self.passes.append(CombinedPass(rules, simple))
+
+    def correct(self, content):
+        """Return the corrected text and the number of replacements made by each rule."""
+        counts = [0] * len(self.rules)
+        for correction_pass in self.passes:
+            content = correction_pass.pattern.sub(lambda match: correction_pass.replacement(match, counts), content)
+        return content, counts
+
+    def correct_stream(self, source, target, chunk_size=1 << 20, overlap=4096, context=256):
+        """Correct text read from the source file object in chunks, writing it to the target file object.
+
+        Each scan runs over the output of the previous one as it is produced, so only a few chunks are
+        in memory at a time. The result is the same as correct() on the whole text as long as every match
+        is shorter than overlap. Returns the number of replacements made by each rule.
+        """
+        counts = [0] * len(self.rules)
+        pieces = iter(lambda: source.read(chunk_size), "")
+        for correction_pass in self.passes:
+            pieces = stream_pass(correction_pass, pieces, counts, overlap, context)
+        for piece in pieces:
+            target.write(piece)
+        return counts
+
+def stream_pass(correction_pass, pieces, counts, overlap, context):
+    """Apply one scan to a stream of text pieces, yielding the corrected text.
+
+    Only matches that start at least overlap characters before the end of the text received so far are
+    replaced; the rest is carried into the next piece, so a match is never cut at a piece boundary as long
+    as it is shorter than overlap. The last context characters before the carried text are kept too, so
+    word boundaries and lookbehinds see what precedes it.
+    """
+    buffer = ""
+    position = 0  # Where the scan resumes in buffer; the text before it is context already yielded
+    pieces = iter(pieces)
+    while True:
+        piece = next(pieces, "")
+        buffer += piece
+        cutoff = len(buffer) if not piece else max(position, len(buffer) - overlap)
+
+        parts = []
+        last = position
+        for match in correction_pass.pattern.finditer(buffer, position):
+            if piece and match.start() >= cutoff:
+                break
+            parts.append(buffer[last:match.start()])
+            parts.append(correction_pass.replacement(match, counts))
+            last = match.end()
+
+        resume = max(last, cutoff)
+        parts.append(buffer[last:resume])
+        output = "".join(parts)
+        if output:
+            yield output
+        if not piece:
+            return
+
+        keep = max(0, resume - context)
+        buffer = buffer[keep:]
+        position = resume - keep
+
+def write_atomically(filename, content):
+    """Write to a temporary file in the same directory and move it into place."""
+    directory = os.path.dirname(os.path.abspath(filename))
+    fd, temp_path = tempfile.mkstemp(dir=directory, prefix='.typos_', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w') as file:
+            file.write(content)
+        # mkstemp creates the file owner-only, so carry over the original permissions
+        os.chmod(temp_path, os.stat(filename).st_mode)
+        os.replace(temp_path, filename)
+    except BaseException:
+        os.remove(temp_path)
+        raise
+
+# Files larger than this are corrected in chunks instead of being read whole, so memory depends on the
+# chunk size rather than the file size. Matches must be shorter than the overlap kept between chunks.
+stream_threshold_bytes = 64 * 1024 * 1024
+stream_chunk_size = 1 << 20
+stream_overlap = 4096
+
+class HashingFile:
+    """Wraps a text file object and hashes the text read from or written to it, as hash_content() would."""
+
+    def __init__(self, file):
+        self.file = file
+        self.digest = hashlib.sha256()
+
+    def read(self, size):
+        text = self.file.read(size)
+        self.digest.update(text.encode('utf-8'))
+        return text
+
+    def write(self, text):
+        self.digest.update(text.encode('utf-8'))
+        return self.file.write(text)
+
+def correct_file_streaming(filename, corrector, recorded_hash=None, rules_current=False):
+    """Correct a large file chunk by chunk into a temporary file, which replaces it if anything changed.
+
+    Returns (counts per rule or None if the file was already corrected, hash before, hash after).
+    """
+    directory = os.path.dirname(os.path.abspath(filename))
+    fd, temp_path = tempfile.mkstemp(dir=directory, prefix='.typos_', suffix='.tmp')
+    try:
+        with open(filename, 'r') as source_file, os.fdopen(fd, 'w') as target_file:
+            source, target = HashingFile(source_file), HashingFile(target_file)
+            counts = corrector.correct_stream(source, target, stream_chunk_size, stream_overlap)
+        original_hash, final_hash = source.digest.hexdigest(), target.digest.hexdigest()
+
+        if rules_current and original_hash == recorded_hash:
+            os.remove(temp_path)
+            return None, original_hash, original_hash
+        if final_hash == original_hash:
+            os.remove(temp_path)
+            return counts, original_hash, original_hash
+
+        # mkstemp creates the file owner-only, so carry over the original permissions
+        os.chmod(temp_path, os.stat(filename).st_mode)
+        os.replace(temp_path, filename)
+        return counts, original_hash, final_hash
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+# Each worker process builds its corrector once
+worker_corrector = None
+
+def init_worker(rules):
+    global worker_corrector
+    worker_corrector = Corrector(rules)
+
+def correct_file(task):
+    """Correct one file in a worker process.
+
+    task is (filename, content hash recorded in the manifest or None, whether the recorded rules are current).
+    Returns (filename, counts per rule or None if the file was already corrected, hash before, hash after,
+    seconds taken).
+    """
+    filename, recorded_hash, rules_current = task
+    start = time.perf_counter()
+    try:
+        if os.path.getsize(filename) > stream_threshold_bytes:
+            counts, original_hash, final_hash = correct_file_streaming(filename, worker_corrector, recorded_hash, rules_current)
+            return filename, counts, original_hash, final_hash, time.perf_counter() - start
+
+        with open(filename, 'r') as file:
+            content = file.read()
+        original_hash = hash_content(content)
+
+        # Only the modification time changed, the text is what the current rules already produced
+        if rules_current and original_hash == recorded_hash:
+            return filename, None, original_hash, original_hash, time.perf_counter() - start
+
+        corrected, counts = worker_corrector.correct(content)
+        if corrected != content:
+            write_atomically(filename, corrected)
+        return filename, counts, original_hash, hash_content(corrected), time.perf_counter() - start
+    except Exception as e:
+        print(f"Error processing {filename}: {e}")
+        return filename, None, None, None, time.perf_counter() - start
+
+def find_text_files(directory):
     for root, _, files in os.walk(directory):
         for file in files:
             if file.endswith('.txt'):  # Adjust this if you want to include other file types
-                file_path = os.path.join(root, file)
-                replace_in_file(file_path, replacements, counts)
-
-    return counts
-
-# List of replacements: (pattern, replacement)
-replacements = [
-    (r'CARL N\. FREEMAN', 'CARL N. FREYMAN'),
-    (r'\b[Rr][Uu][Ee][Yy]\b', 'RUBY'),
-    (r'CARL H\. FREEMAN', 'CARL N. FREYMAN'),
-    (r'CARL NICHOLAS FREEMAN', 'CARL NICHOLAS FREYMAN'),
-    (r'CARL M\. FREEMAN', 'CARL N. FREYMAN')
-]
-
-# Example usage: replace 'your_directory' with the actual directory you want to process
-directory = '/home/user/carl_files/output_text/'
-counts = process_directory(directory, replacements)
-
-# Print out the number of occurrences for each regular expression
-print(f"Processed {directory}")
-for pattern, count in counts.items():
-    print(f"Pattern '{pattern}' was used {count} time(s).")
+                yield os.path.join(root, file)
+
+def batched(iterable, size):
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def create_executor(rules, workers=None):
+    """Create a process pool whose workers each hold a corrector for the rules."""
+    return ProcessPoolExecutor(max_workers=workers, initializer=init_worker, initargs=(rules,))
+
+def process_directory(directory, rules, workers=None, chunksize=64, manifest=None):
+    """Correct the text files under the directory with a pool of worker processes. Returns the counts per rule."""
+    with create_executor(rules, workers) as executor:
+        return process_files(find_text_files(directory), rules, executor, chunksize, manifest)
+
+def process_files(filenames, rules, executor, chunksize=64, manifest=None):
+    """Correct the given text files with an executor from create_executor(). Returns the counts per rule.
+
+    With a manifest, files whose size and modification time match the manifest and that were corrected
+    with the current rules are skipped without being read, so reruns only touch new or changed files.
+    """
+    version = rules_version(rules)
+    totals = [0] * len(rules)
+    stats = {"skipped": 0, "processed": 0}
+
+    def tasks():
+        for filename in filenames:
+            recorded = manifest.lookup(filename) if manifest is not None else None
+            if recorded is None:
+                yield filename, None, False
+                continue
+
+            size, mtime_ns, content_hash, recorded_version, _ = recorded
+            stat = os.stat(filename)
+            if recorded_version == version and (stat.st_size, stat.st_mtime_ns) == (size, mtime_ns):
+                stats["skipped"] += 1
+                continue
+            yield filename, content_hash, recorded_version == version
+
+    # Submit in batches so the number of pending futures stays bounded on very large trees
+    for batch in batched(tasks(), 4096):
+        records = []
+        for filename, counts, original_hash, final_hash, elapsed in executor.map(correct_file, batch, chunksize=chunksize):
+            if final_hash is None:
+                continue  # The file could not be processed
+            stats["processed"] += 1
+            metrics.record("correct", elapsed, filename)
+
+            if counts is not None:
+                totals = [total + count for total, count in zip(totals, counts)]
+            if manifest is None:
+                continue
+
+            recorded = manifest.lookup(filename)
+            file_counts = {rule.pattern: count for rule, count in zip(rules, counts or [0] * len(rules))}
+            # Counts accumulate while the text is the output of earlier corrections, and restart when
+            # the file was replaced with new text, for example a fresh OCR of the page
+            if recorded is not None and recorded[2] == original_hash:
+                for pattern, count in recorded[4].items():
+                    file_counts[pattern] = file_counts.get(pattern, 0) + count
+
+            stat = os.stat(filename)
+            records.append((filename, stat.st_size, stat.st_mtime_ns, final_hash, version, file_counts))
+
+        if manifest is not None:
+            manifest.record(records)
+
+    print(f"Processed {stats['processed']} file(s), skipped {stats['skipped']} unchanged file(s)")
+    return {rule.pattern: total for rule, total in zip(rules, totals)}
+
+if __name__ == "__main__":
+    # Usage: python typos.py [directory] [rules_file] [manifest_file]
+    directory = sys.argv[1] if len(sys.argv) > 1 else '/home/user/carl_files/output_text/'
+    rules_file = sys.argv[2] if len(sys.argv) > 2 else os.path.join(os.path.dirname(os.path.abspath(__file__)), 'typo_rules.tsv')
+    manifest_file = sys.argv[3] if len(sys.argv) > 3 else 'manifest_typos.sqlite'
+
+    metrics.configure("./metrics/typos.jsonl")
+    rules = load_rules(rules_file)
+    manifest = CorrectionManifest(manifest_file)
+    counts = process_directory(directory, rules, manifest=manifest)
+
+    # Print out the number of occurrences for each regular expression
+    print(f"Processed {directory}")
+    for pattern, count in counts.items():
+        print(f"Pattern '{pattern}' was used {count} time(s) in this run.")
+
+    # Corpus-wide totals come from the manifest, without rescanning any file
+    print("Corpus totals:")
+    for pattern, count in manifest.total_counts().items():
+        print(f"Pattern '{pattern}' was used {count} time(s).")
+    manifest.close()
+    metrics.report("./metrics/typos_summary.json", output=print)